@@ -0,0 +1,87 @@
+"""
+Shows the query plans (EXPLAIN ANALYZE) of the hot queries against the configured database,
+to check the indexes of sql/indexes.sql are used.
+
+    python -m benchmarks.query_plans --building_id=NL.IMBAG.Pand.0599100000601466 --bbox 92000 436000 93000 437000
+
+surfaces: the surfaces of one building (index only scan on the covering bag_building_id index)
+images: the streetview and aerial images of those surfaces (index scans on surface_id)
+area: the buildings with their surfaces in a bbox (bitmap / index scan on the buildings gist index)
+"""
+import argparse
+from time import perf_counter
+
+from sqlalchemy import LargeBinary, func, select
+
+from models.dataclass_mappings.buildings import Building
+from models.dataclass_mappings.image import AerialImage, StreetviewImage
+from models.dataclass_mappings.surfaces import Surface
+from src.bag_extractor.handler_base import SessionHandler
+
+
+def explain(connection, title: str, statement, repeat: int) -> None:
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+    plan = connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {compiled.string}", compiled.params).fetchall()
+
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        connection.exec_driver_sql(compiled.string, compiled.params).fetchall()
+        timings.append(perf_counter() - start)
+
+    print(f"== {title}: best of {repeat} {min(timings) * 1000:.2f} ms")
+    for (line,) in plan:
+        print(f"   {line}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--building_id', default=None, help="defaults to the first building in the database")
+    parser.add_argument('--bbox', type=float, nargs=4, default=None, help="x min, y min, x max, y max in EPSG:28992")
+    parser.add_argument('--repeat', type=int, default=5)
+    arguments = parser.parse_args()
+
+    engine = SessionHandler().engine
+    with engine.connect() as connection:
+        building_id = arguments.building_id or connection.execute(
+            select(Building.id).order_by(Building.id).limit(1)
+        ).scalar()
+        surface_ids = [
+            str(surface_id)
+            for surface_id in connection.execute(select(Surface.id).where(Surface.bag_building_id == building_id)).scalars()
+        ]
+        print(f"building {building_id} with {len(surface_ids)} surfaces")
+
+        explain(
+            connection,
+            "surfaces",
+            select(Surface.id, Surface.semantics_value).where(Surface.bag_building_id == building_id),
+            arguments.repeat
+        )
+        if surface_ids:
+            for model in (StreetviewImage, AerialImage):
+                explain(
+                    connection,
+                    f"images {model.__tablename__}",
+                    select(model.id, model.surface_id).where(model.surface_id.in_(surface_ids)),
+                    arguments.repeat
+                )
+        if arguments.bbox is not None:
+            explain(
+                connection,
+                "area",
+                select(
+                    Building.id,
+                    Surface.id,
+                    Surface.semantics_value,
+                    func.ST_AsBinary(Surface.surface_geometry, type_=LargeBinary)
+                )
+                .select_from(Building)
+                .join(Surface, Surface.bag_building_id == Building.id)
+                .where(func.ST_Intersects(Building.__table__.c.geometry, func.ST_MakeEnvelope(*arguments.bbox, 28992))),
+                arguments.repeat
+            )
+
+
+if __name__ == '__main__':
+    main()
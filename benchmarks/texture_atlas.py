@@ -0,0 +1,150 @@
+"""
+Compares per-surface textures with texture atlases for a synthetic building.
+
+    python -m benchmarks.texture_atlas --surfaces=200 --repeat=5 --texture_format=jpeg
+
+files: texture files written, every one is a separate request / decode for a viewer
+binds: texture binds (draw call batches) the model needs, the gain the atlas is for
+kB: size of the texture files on disk
+save: generate and write the model with its images, the textures are encoded on the writer pool
+load: read the model and decode every texture it refers to, as a viewer would
+render prep: group the textured rings per texture, every group is one texture bind / draw call
+
+The synthetic images are random noise, which doesn't compress, so png encoding dominates the save time of an atlas;
+the per surface layout writes the stored pngs as they are, jpeg encodes both layouts.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from PIL import Image
+from shapely.geometry import Polygon
+
+from models.dataclass_mappings.buildings import Building_dataclass
+from models.dataclass_mappings.image import Aerial_Image_dataclass
+from models.dataclass_mappings.surfaces import Surface_dataclass, Surface_type
+from src.model_generator.cityjson_dict_generator import CityJSONDictGenerator
+from src.model_generator.image_writer import ImageWriter
+from src.model_generator.texture_atlas import TextureAtlasPacker
+
+
+def synthetic_building(walls: int, height: float = 10.0):
+    """
+    A prism with the given amount of walls, a ground and a roof surface and an image per surface.
+    """
+    x, y, radius = 155000.0, 463000.0, 20.0
+    footprint = [
+        (x + radius * math.cos(2 * math.pi * i / walls), y + radius * math.sin(2 * math.pi * i / walls))
+        for i in range(walls)
+    ]
+    surfaces = [
+        Surface_dataclass(id='ground', bag_building_id='benchmark', semantics_value=Surface_type.GroundSurface,
+                          surface_geometry=Polygon([(a, b, 0.0) for a, b in footprint])),
+        Surface_dataclass(id='roof', bag_building_id='benchmark', semantics_value=Surface_type.RoofSurface,
+                          surface_geometry=Polygon([(a, b, height) for a, b in footprint])),
+    ]
+    for i in range(walls):
+        (x1, y1), (x2, y2) = footprint[i], footprint[(i + 1) % walls]
+        surfaces.append(Surface_dataclass(
+            id=f'wall_{i}', bag_building_id='benchmark', semantics_value=Surface_type.OuterWallSurface,
+            surface_geometry=Polygon([(x1, y1, 0.0), (x2, y2, 0.0), (x2, y2, height), (x1, y1, height)])
+        ))
+
+    random = np.random.default_rng(0)
+    images = []
+    for surface in surfaces:
+        width, image_height = int(random.integers(64, 320)), int(random.integers(64, 320))
+        pixels = random.integers(0, 255, (image_height, width, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format='PNG')
+        images.append(Aerial_Image_dataclass(id=surface.id, surface_id=surface.id, image=buffer.getvalue(),
+                                      image_width=width, image_height=image_height))
+    return Building_dataclass(id='benchmark', surfaces=surfaces), images
+
+
+def load(path: str, output_dir: str) -> dict:
+    with open(path) as file:
+        cityjson = json.load(file)
+    for texture in cityjson["appearance"]["textures"]:
+        with Image.open(os.path.join(output_dir, texture["image"].lstrip('/'))) as image:
+            image.load()
+    return cityjson
+
+
+def texture_files(cityjson: dict, output_dir: str) -> list:
+    return [os.path.join(output_dir, texture["image"].lstrip('/')) for texture in cityjson["appearance"]["textures"]]
+
+
+def render_prep(cityjson: dict) -> int:
+    uvs = np.asarray(cityjson["appearance"]["vertices-texture"])
+    batches = {}
+    for city_object in cityjson["CityObjects"].values():
+        for geometry in city_object.get("geometry", []):
+            for theme in geometry.get("texture", {}).values():
+                for shell in theme["values"]:
+                    for surface in shell:
+                        for ring in surface:
+                            batches.setdefault(ring[0], []).append(uvs[ring[1:]])
+    for texture, rings in batches.items():
+        batches[texture] = np.concatenate(rings)
+    return len(batches)
+
+
+def run(generator: CityJSONDictGenerator, building, images, repeat: int) -> dict:
+    timings = {"save": [], "load": [], "render prep": []}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = perf_counter()
+            cm = generator.generate(building=building, textures_enabled=True)
+            generator.save(building=building, images=images, cm=cm, filename='benchmark', output_dir=output_dir)
+            timings["save"].append(perf_counter() - start)
+
+            start = perf_counter()
+            cityjson = load(os.path.join(output_dir, building.id, 'benchmark.json'), output_dir)
+            timings["load"].append(perf_counter() - start)
+
+            start = perf_counter()
+            binds = render_prep(cityjson)
+            timings["render prep"].append(perf_counter() - start)
+
+            files = texture_files(cityjson, output_dir)
+            size = sum(os.path.getsize(path) for path in files)
+    result = {name: min(values) * 1000 for name, values in timings.items()}
+    result.update(files=len(files), binds=binds, kilobytes=size / 1024)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--surfaces", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--texture_format", choices=list(ImageWriter.FORMATS), default='png')
+    parser.add_argument("--workers", type=int, default=None, help="texture encoding threads, defaults to the cpus")
+    arguments = parser.parse_args()
+
+    building, images = synthetic_building(walls=max(arguments.surfaces - 2, 3))
+    results = {}
+    for name, texture_atlas in (("per surface", None), ("atlas", TextureAtlasPacker())):
+        image_writer = ImageWriter(image_format=arguments.texture_format, workers=arguments.workers)
+        generator = CityJSONDictGenerator(image_writer=image_writer, texture_atlas=texture_atlas)
+        results[name] = run(generator, building, images, arguments.repeat)
+        image_writer.close()
+    print(
+        f"{len(building.surfaces)} surfaces, {arguments.texture_format}, "
+        f"{image_writer.workers} encoding threads, best of {arguments.repeat}"
+    )
+    print(f"{'':<12}{'files':>8}{'binds':>8}{'kB':>10}{'save ms':>10}{'load ms':>10}{'prep ms':>10}")
+    for name, result in results.items():
+        print(
+            f"{name:<12}{result['files']:>8}{result['binds']:>8}{result['kilobytes']:>10.0f}"
+            f"{result['save']:>10.1f}{result['load']:>10.1f}{result['render prep']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,8 @@ from geoalchemy2 import Geometry
 from typing import List
 import uuid
 
-from sqlalchemy import ForeignKey, MetaData, Column
-from sqlalchemy.types import String, Integer, LargeBinary
+from sqlalchemy import ForeignKey, Index, MetaData, Column, UniqueConstraint, func
+from sqlalchemy.types import String, Integer, LargeBinary, DateTime
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm.mapper import Mapper
 
@@ -32,6 +32,14 @@ class Streetview_Image_dataclass(Image_dataclass):
 class Aerial_Image_dataclass(Image_dataclass):
     surface_id: uuid = None
 
+@dataclass
+class Aerial_Tile_dataclass(Image_dataclass):
+    """
+    One aerial image covering the roofs of several surfaces,
+    only used to crop the roofs from, it isn't stored itself.
+    """
+    surface_ids: List = field(default_factory=list)
+
 class Image(models.BaseTable):
     __abstract__ = True
 
@@ -39,10 +47,15 @@ class Image(models.BaseTable):
     image_width = Column("image_width", Integer())
     image_height = Column("image_height", Integer())
     image = Column("image", LargeBinary())
+    created_at = Column("created_at", DateTime(timezone=True), server_default=func.now())
 
 class StreetviewImage(Image, models.BaseTable):
     __tablename__ = 'cyclomedia_streetview_images'
-    __table_args__ = {"schema": models.RESULT_SCHEMA}
+    __table_args__ = (
+        UniqueConstraint('panorama_id', 'surface_id', name='unique_pano_surface_uk'),
+        Index('streetview_images_surface_id', 'surface_id'),
+        {"schema": models.RESULT_SCHEMA}
+    )
 
     panorama_id = Column("panorama_id", String(), primary_key=True)
     surface_id = Column(
@@ -56,7 +69,10 @@ Mapper(Streetview_Image_dataclass, StreetviewImage)
 
 class AerialImage(Image, models.BaseTable):
     __tablename__ = 'cyclomedia_aerial_image'
-    __table_args__ = {"schema": models.RESULT_SCHEMA}
+    __table_args__ = (
+        UniqueConstraint('surface_id', name='unique_aerial_surface_uk'),
+        {"schema": models.RESULT_SCHEMA}
+    )
 
     surface_id = Column(
         'surface_id', String(),
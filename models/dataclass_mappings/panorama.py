@@ -1,7 +1,7 @@
 from dataclasses import dataclass, field
 from typing import List
 import uuid
-from sqlalchemy import MetaData, Column, ForeignKey
+from sqlalchemy import MetaData, Column, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.types import String, Date
 from sqlalchemy.dialects.postgresql import UUID
 from geoalchemy2 import Geometry
@@ -15,7 +15,11 @@ metadata = MetaData()
 
 class Panorama(models.BaseTable):
     __tablename__ = 'cyclomedia_streetview_panorama'
-    __table_args__ = {"schema": models.RESULT_SCHEMA}
+    __table_args__ = (
+        UniqueConstraint('panorama_id', 'surface_id', name='unique_panorama_surface_uk'),
+        Index('streetview_panorama_surface_id', 'surface_id'),
+        {"schema": models.RESULT_SCHEMA}
+    )
 
     id = Column("id", UUID(as_uuid=True), primary_key=True)
     panorama_id = Column(
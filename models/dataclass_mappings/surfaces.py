@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, String
+from sqlalchemy import Column, ForeignKey, Index, String
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import mapper
 
@@ -22,7 +22,14 @@ class Surface_type(Enum):
 
 class Surface(models.BaseTable):
     __tablename__ = 'surfaces'
-    __table_args__ = {"schema": models.RESULT_SCHEMA}
+    __table_args__ = (
+        # the surface ids of a building are read from the index alone
+        Index(
+            'surfaces_3d_bag_building_ids_covering', 'bag_building_id',
+            postgresql_include=['id', 'semantics_value']
+        ),
+        {"schema": models.RESULT_SCHEMA}
+    )
 
     id = Column('id', UUID(), primary_key=True)
     bag_building_id = Column(
@@ -4,6 +4,8 @@ CREATE TABLE "data".cyclomedia_aerial_image (
 	image_width int NULL,
 	image_height int NULL,
     image bytea NULL,
+	created_at timestamptz NOT NULL DEFAULT now(),
 	CONSTRAINT aerial_pk_id PRIMARY KEY (id),
-	CONSTRAINT fk_aerial_surfaces FOREIGN KEY (surface_id) REFERENCES "data".surfaces(id)
+	CONSTRAINT fk_aerial_surfaces FOREIGN KEY (surface_id) REFERENCES "data".surfaces(id),
+	CONSTRAINT unique_aerial_surface_uk UNIQUE (surface_id)
 );
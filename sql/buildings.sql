@@ -7,3 +7,6 @@ FROM bag3d.pand;
 -- add primary key
 ALTER TABLE data.buildings 
 ADD PRIMARY KEY (id); 
+
+-- spatial index for the area (tile) queries
+CREATE INDEX idx_buildings_geometry ON data.buildings USING gist (geometry);
@@ -0,0 +1,7 @@
+-- adds the fetch timestamp the image cache uses to decide when an image needs to be fetched again,
+-- for databases created before it was part of the table scripts.
+ALTER TABLE "data".cyclomedia_streetview_images
+ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now();
+
+ALTER TABLE "data".cyclomedia_aerial_image
+ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now();
@@ -0,0 +1,18 @@
+-- adds the unique keys the image upserts (INSERT ... ON CONFLICT) rely on, for databases created before they were part of the table scripts.
+-- duplicates are removed first, keeping one row per key.
+DELETE FROM "data".cyclomedia_aerial_image a
+USING "data".cyclomedia_aerial_image b
+WHERE a.surface_id = b.surface_id
+AND a.ctid > b.ctid;
+
+ALTER TABLE "data".cyclomedia_aerial_image
+ADD CONSTRAINT unique_aerial_surface_uk UNIQUE (surface_id);
+
+DELETE FROM "data".cyclomedia_streetview_panorama a
+USING "data".cyclomedia_streetview_panorama b
+WHERE a.panorama_id = b.panorama_id
+AND a.surface_id = b.surface_id
+AND a.ctid > b.ctid;
+
+ALTER TABLE "data".cyclomedia_streetview_panorama
+ADD CONSTRAINT unique_panorama_surface_uk UNIQUE (panorama_id, surface_id);
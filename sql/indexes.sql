@@ -0,0 +1,25 @@
+-- adds the spatial, image and covering indexes, for databases created before they were part of the table scripts.
+-- CONCURRENTLY keeps the tables writable while building, so run this outside of a transaction (plain psql -f).
+
+-- area queries (ST_Intersects) on buildings, surfaces and the bag3d grid tiles
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_buildings_geometry ON "data".buildings USING gist (geometry);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_surfaces_surface_geometry ON "data".surfaces USING gist (surface_geometry);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS grid_geometrie_gist ON bag3d.grid USING gist (geometrie);
+
+-- surface fetch per building: the surface ids and semantics come straight from the index (index only scan),
+-- this replaces the plain index on bag_building_id.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS surfaces_3d_bag_building_ids_covering
+ON "data".surfaces (bag_building_id) INCLUDE (id, semantics_value);
+DROP INDEX CONCURRENTLY IF EXISTS "data".surfaces_3d_bag_building_ids;
+-- duplicates the primary key on id.
+DROP INDEX CONCURRENTLY IF EXISTS "data".surfaces_3d_id;
+
+-- image lookups and refresh deletes on surface_id IN (...), the unique keys of the streetview tables start with
+-- panorama_id so they can't be used for these. The aerial images are covered by their unique key on surface_id.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS streetview_images_surface_id ON "data".cyclomedia_streetview_images (surface_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS streetview_panorama_surface_id ON "data".cyclomedia_streetview_panorama (surface_id);
+
+ANALYZE "data".buildings;
+ANALYZE "data".surfaces;
+ANALYZE "data".cyclomedia_streetview_images;
+ANALYZE "data".cyclomedia_streetview_panorama;
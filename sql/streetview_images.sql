@@ -5,7 +5,11 @@ CREATE TABLE "data".cyclomedia_streetview_images (
 	image_width int NULL,
 	image_height int4 NULL,
 	image bytea NULL,
+	created_at timestamptz NOT NULL DEFAULT now(),
 	CONSTRAINT pk_image_id PRIMARY KEY (id),
 	CONSTRAINT fk_streeview_surface FOREIGN KEY (surface_id) REFERENCES "data".surfaces(id),
 	CONSTRAINT unique_pano_surface_uk UNIQUE (panorama_id, surface_id)
 );
+
+-- images are looked up by surface, the unique key starts with panorama_id
+CREATE INDEX streetview_images_surface_id ON "data".cyclomedia_streetview_images (surface_id);
@@ -5,5 +5,8 @@ CREATE TABLE "data".cyclomedia_streetview_panorama (
 	recording_location geometry NULL,
 	recording_date date NULL,
 	CONSTRAINT panorama_pk_od PRIMARY KEY (id),
-	CONSTRAINT fk_streetview_image FOREIGN KEY (panorama_id,surface_id) REFERENCES "data".cyclomedia_streetview_images(panorama_id, surface_id)
+	CONSTRAINT fk_streetview_image FOREIGN KEY (panorama_id,surface_id) REFERENCES "data".cyclomedia_streetview_images(panorama_id, surface_id),
+	CONSTRAINT unique_panorama_surface_uk UNIQUE (panorama_id, surface_id)
 );
+
+CREATE INDEX streetview_panorama_surface_id ON "data".cyclomedia_streetview_panorama (surface_id);
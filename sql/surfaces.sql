@@ -8,6 +8,7 @@ CREATE TABLE "data".surfaces (
 	CONSTRAINT surfaces_bag_building_id_fk FOREIGN KEY (bag_building_id) REFERENCES "data".buildings(id)
 );
 
+-- the load-surfaces command of src/cli.py does the same in parallel, resumable partitions.
 -- create temp table, not inserting directly because temp table generation uses parallel workers.
 create temp table surfaces_split as 
 with unnested_surfaces as (
@@ -28,12 +29,13 @@ end as surface_type
 from unnested_surfaces
 join bag3d.pand on 
 unnested_surfaces.fid = pand.fid;
-unnested_surfaces.fid = pand.fid;
 
 -- insert
 insert into "data".surfaces 
 select * from surfaces_split;
 
 -- index creating else querying will take VERY long.
-CREATE INDEX surfaces_3d_bag_building_ids ON data.surfaces (bag_building_id);
-CREATE INDEX surfaces_3d_id ON data.surfaces (id);
\ No newline at end of file
+-- the covering index lets the surface ids of a building be read from the index alone.
+CREATE INDEX surfaces_3d_bag_building_ids_covering ON data.surfaces (bag_building_id) INCLUDE (id, semantics_value);
+CREATE INDEX idx_surfaces_surface_geometry ON data.surfaces USING gist (surface_geometry);
+ANALYZE data.surfaces;
\ No newline at end of file
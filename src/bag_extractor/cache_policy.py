@@ -0,0 +1,42 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from os import getenv
+from typing import Optional
+
+
+@dataclass
+class ImageCachePolicy:
+    """
+    Decides which stored images can be reused instead of being fetched again.
+
+    enabled: when False every surface is fetched again.
+    max_age: images older than this are fetched again, None means stored images never expire.
+    """
+    enabled: bool = True
+    max_age: Optional[timedelta] = None
+
+    @classmethod
+    def from_env(cls) -> 'ImageCachePolicy':
+        """
+        Reads image_cache_enabled (true/false) and image_cache_max_age_days from the environment.
+        """
+        max_age_days = getenv('image_cache_max_age_days')
+        return cls(
+            enabled=getenv('image_cache_enabled', 'true').lower() == 'true',
+            max_age=timedelta(days=float(max_age_days)) if max_age_days else None
+        )
+
+    @property
+    def refreshes(self) -> bool:
+        """
+        True when fetched images can replace stored ones, i.e. stored images can expire.
+        """
+        return not self.enabled or self.max_age is not None
+
+    def cutoff(self) -> Optional[datetime]:
+        """
+        Images created before the cutoff are stale.
+        """
+        if self.max_age is None:
+            return None
+        return datetime.now(timezone.utc) - self.max_age
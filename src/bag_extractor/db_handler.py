@@ -1,16 +1,39 @@
 import sys
-from typing import List, Union
+from dataclasses import fields
+from os import getenv
+from typing import Iterator, List, Sequence, Tuple, Union
 
+from src.bag_extractor.cache_policy import ImageCachePolicy
 from src.bag_extractor.handler_base import Collector
+from src.polygon_calculator.raster_image import RasterImage
 from psycopg2.errors import NoDataFound
-from geoalchemy2.shape import to_shape
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.session import Session
+from sqlalchemy.types import LargeBinary
 
+try:
+    # shapely >= 2.0 decodes arrays of WKB at once
+    from shapely import from_wkb as vectorized_from_wkb
+except ImportError:
+    vectorized_from_wkb = None
+    from shapely.geos import WKBReader, lgeos
 
-from models.dataclass_mappings.surfaces import Surface_dataclass
-from models.dataclass_mappings.buildings import Building_dataclass
+
+from models import BaseTable
+from models.dataclass_mappings.surfaces import Surface, Surface_dataclass
+from models.dataclass_mappings.buildings import Building, Building_dataclass
 from models.dataclass_mappings.image import Image, StreetviewImage, AerialImage
+from models.dataclass_mappings.panorama import Panorama
+from models.grid import Grid
 class BagCollector(Collector):
 
+    def __init__(self) -> None:
+        super().__init__()
+        # images are several MB each, keep the insert statements reasonably small.
+        self.upsert_chunk_size = int(getenv('db_upsert_chunk_size', 50))
+
     def collect_building(self, bag_building_id):
         """
         Queries from the data.buildings table to get the correct surfaces
@@ -19,10 +42,7 @@ class BagCollector(Collector):
         3. return result as one building dataclass
         """
         try:
-            building = self._collect_single_building(bag_building_id)
-            building.surfaces = self._collect_surfaces(bag_building_id)
-            self._transform_to_wkt(building=building)
-            return building
+            return self.fetch_building(bag_building_id)
         except NoDataFound as e:
             self.logger.warning(e)
             sys.exit(0)
@@ -31,11 +51,126 @@ class BagCollector(Collector):
             sys.exit(1)
 
 
+    def fetch_building(self, bag_building_id: str, session: Session = None) -> Building_dataclass:
+        """
+        Same as collect_building, but raises NoDataFound instead of exiting,
+        so batch runs can skip a missing building and continue.
+        """
+        buildings = self.collect_buildings([bag_building_id], session=session)
+        if not buildings:
+            raise NoDataFound("Bag building id not found!")
+        building = buildings[0]
+        if not building.surfaces:
+            raise NoDataFound("surface ids with specified bag building id not found!")
+        return building
+
+    def collect_buildings(self, bag_building_ids: List[str], session: Session = None) -> List[Building_dataclass]:
+        """
+        Set based variant of fetch_building, queries buildings and their surfaces in one round trip.
+        The geometries are fetched as WKB and decoded in bulk.
+        Unknown ids are left out of the result, buildings without surfaces get an empty list.
+        """
+        with self.session_factory.reuse(session) as session:
+            query = session.query(
+                Building.id,
+                Surface.id,
+                Surface.semantics_value,
+                func.ST_AsBinary(Surface.surface_geometry, type_=LargeBinary)
+            )
+            query = query.select_from(Building)
+            query = query.outerjoin(Surface, Surface.bag_building_id == Building.id)
+            query = query.where(Building.id.in_(bag_building_ids))
+            rows = query.all()
+        return self._to_buildings(rows)
+
+    def collect_buildings_in_area(
+        self,
+        bbox: Sequence[float] = None,
+        tile_id: int = None,
+        session: Session = None
+    ) -> List[Building_dataclass]:
+        """
+        All buildings (with their surfaces) intersecting an EPSG:28992 bbox (x min, y min, x max, y max)
+        or the geometry of a tile in the bag3d grid, queried in one round trip with ST_Intersects.
+        """
+        if (bbox is None) == (tile_id is None):
+            raise ValueError("supply either a bbox or a tile id")
+        if bbox is not None:
+            area = func.ST_MakeEnvelope(*bbox, 28992)
+        else:
+            area = select(Grid.geometrie).where(Grid.fid == tile_id).scalar_subquery()
+
+        with self.session_factory.reuse(session) as session:
+            query = session.query(
+                Building.id,
+                Surface.id,
+                Surface.semantics_value,
+                func.ST_AsBinary(Surface.surface_geometry, type_=LargeBinary)
+            )
+            query = query.select_from(Building)
+            query = query.join(Surface, Surface.bag_building_id == Building.id)
+            query = query.where(func.ST_Intersects(Building.__table__.c.geometry, area))
+            query = query.order_by(Building.id)
+            rows = query.all()
+        return self._to_buildings(rows)
+
+    def collect_surface_images(self, surface_ids: List, session: Session = None, chunk_size: int = 5000) -> List:
+        """
+        The stored streetview and aerial images of the surfaces,
+        surfaces without images are left out instead of raising NoDataFound.
+        """
+        surface_ids = [str(surface_id) for surface_id in surface_ids]
+        images = []
+        with self.session_factory.reuse(session) as session:
+            for model in (StreetviewImage, AerialImage):
+                for start in range(0, len(surface_ids), chunk_size):
+                    query = session.query(model)
+                    query = query.filter(model.surface_id.in_(surface_ids[start:start + chunk_size]))
+                    images.extend(query.all())
+        return images
+
+    def _to_buildings(self, rows: List) -> List[Building_dataclass]:
+        """
+        Groups (building id, surface id, semantics value, wkb) rows into buildings,
+        the geometries are decoded in bulk.
+        """
+        geometries = iter(self._decode_geometries([row[3] for row in rows if row[1] is not None]))
+
+        buildings = {}
+        for building_id, surface_id, semantics_value, _ in rows:
+            if building_id not in buildings:
+                buildings[building_id] = Building_dataclass(id=building_id, surfaces=[])
+            if surface_id is None:
+                continue
+            buildings[building_id].surfaces.append(
+                Surface_dataclass(
+                    id=surface_id,
+                    bag_building_id=building_id,
+                    semantics_value=semantics_value,
+                    surface_geometry=next(geometries)
+                )
+            )
+        return list(buildings.values())
+
+    def collect_building_ids(self, bag_building_id_prefix: str = None) -> Iterator[str]:
+        """
+        Yields all bag building ids, optionally filtered on a prefix
+        (the first 4 digits of a bag id are the municipality code).
+        """
+        with self.session_factory.build() as session:
+            query = session.query(Building_dataclass.id)
+            if bag_building_id_prefix:
+                query = query.where(Building_dataclass.id.startswith(bag_building_id_prefix))
+            query = query.order_by(Building_dataclass.id)
+            for row in query.yield_per(1000):
+                yield row[0]
+
     def collect_images(self, bag_building_id) -> Union[List, List]:
         try:
-            surface_ids = [id[0] for id in self._collect_surface_ids(bag_building_id)]
-            streetview_images = self._collect_images(surface_ids, StreetviewImage)
-            aerial_images = self._collect_images(surface_ids, AerialImage)
+            with self.session_factory.build() as session:
+                surface_ids = [id[0] for id in self._collect_surface_ids(bag_building_id, session=session)]
+                streetview_images = self._collect_images(surface_ids, StreetviewImage, session=session)
+                aerial_images = self._collect_images(surface_ids, AerialImage, session=session)
             return streetview_images, aerial_images
         except NoDataFound as e:
             self.logger.warning(e)
@@ -44,52 +179,161 @@ class BagCollector(Collector):
             self.logger.warning(e)
             sys.exit(1)
 
-    # TODO: caveat: no checks with duplicate when bulk_saving
+    def collect_cached_images(
+        self,
+        outer_wall_bboxes: List,
+        roof_bboxes: List,
+        policy: ImageCachePolicy,
+        session: Session = None
+    ) -> Tuple[List, List, List, List]:
+        """
+        Splits the bounding boxes into surfaces which already have a stored image that is still fresh
+        according to the policy, and surfaces which still need to be fetched.
+        Does one query per image table for all supplied bounding boxes.
+
+        Returns the cached streetview images, the missing wall bboxes,
+        the cached aerial images and the missing roof bboxes.
+        """
+        if not policy.enabled:
+            return [], outer_wall_bboxes, [], roof_bboxes
+
+        with self.session_factory.reuse(session) as session:
+            cached_streetview_images = self._collect_fresh_images(outer_wall_bboxes, StreetviewImage, policy, session)
+            cached_aerial_images = self._collect_fresh_images(roof_bboxes, AerialImage, policy, session)
+
+        missing_outer_wall_bboxes = self._filter_uncached(outer_wall_bboxes, cached_streetview_images)
+        missing_roof_bboxes = self._filter_uncached(roof_bboxes, cached_aerial_images)
+        self.logger.info(
+            f"image cache: {len(outer_wall_bboxes) - len(missing_outer_wall_bboxes)}/{len(outer_wall_bboxes)} walls, "
+            f"{len(roof_bboxes) - len(missing_roof_bboxes)}/{len(roof_bboxes)} roofs already stored"
+        )
+        return cached_streetview_images, missing_outer_wall_bboxes, cached_aerial_images, missing_roof_bboxes
+
     def store_streetview(
         self,
         panorama_recordings: List,
-        streetview_image_recordings: List
+        streetview_image_recordings: List,
+        chunk_size: int = None,
+        refresh: bool = False,
+        session: Session = None
     ) -> None:
-
-        with self.session_factory.build() as session:
+        """
+        Upserts the streetview images and their panorama's,
+        recordings that are already stored for a (panorama_id, surface_id) are skipped.
+        With refresh, the stored recordings of the supplied surfaces are replaced instead.
+        A supplied session is committed (or rolled back) by the store.
+        """
+        chunk_size = chunk_size or self.upsert_chunk_size
+        with self.session_factory.reuse(session) as session:
             try:
+                if refresh:
+                    self._delete_surface_images(session, Panorama, panorama_recordings)
+                    self._delete_surface_images(session, StreetviewImage, streetview_image_recordings)
                 self.logger.info("Inserting streetview images into db")
-                session.bulk_save_objects(streetview_image_recordings)
+                inserted = self._upsert(
+                    session, StreetviewImage, streetview_image_recordings, ["panorama_id", "surface_id"], chunk_size
+                )
+                self.logger.info(f"Inserted {inserted} new streetview images")
                 self.logger.info("Inserting streetview panorama's into db")
-                session.bulk_save_objects(panorama_recordings)
+                self._upsert(session, Panorama, panorama_recordings, ["panorama_id", "surface_id"], chunk_size)
                 session.commit()
             except Exception as e:
                 self.logger.error("Error bulk inserting in db")
                 self.logger.error(e)
                 session.rollback()
 
-    # TODO: caveat: no checks with duplicate when bulk_saving
-    def store_aerial(self, cropped_roof_images: List) -> None:
-
-        with self.session_factory.build() as session:
+    def store_aerial(
+        self,
+        cropped_roof_images: List,
+        chunk_size: int = None,
+        refresh: bool = False,
+        session: Session = None
+    ) -> None:
+        """
+        Upserts the cropped aerial images, surfaces that already have an image are skipped.
+        With refresh, the stored images of the supplied surfaces are replaced instead.
+        A supplied session is committed (or rolled back) by the store.
+        """
+        chunk_size = chunk_size or self.upsert_chunk_size
+        with self.session_factory.reuse(session) as session:
             try:
+                if refresh:
+                    self._delete_surface_images(session, AerialImage, cropped_roof_images)
                 self.logger.info("Inserting cropped aerial images into db")
-                session.bulk_save_objects(cropped_roof_images)
+                inserted = self._upsert(session, AerialImage, cropped_roof_images, ["surface_id"], chunk_size)
+                self.logger.info(f"Inserted {inserted} new aerial images")
                 session.commit()
             except Exception as e:
                 self.logger.error("Error bulk inserting in db")
                 self.logger.error(e)
                 session.rollback()
 
-    def _collect_single_building(self, bag_building_id: str = None):
-        with self.session_factory.build() as session:
-            query = session.query(Building_dataclass)
-            query = query.where(bag_building_id == Building_dataclass.id)
-            res = query.all()
-            if not res:
-                raise NoDataFound("Bag building id not found!")
-            return res[0]
-    
-    def _collect_surfaces(self, bag_building_id: str = None):
+    def _collect_fresh_images(
+        self,
+        bboxes: List,
+        model: Image,
+        policy: ImageCachePolicy,
+        session: Session
+    ) -> List:
+        surface_ids = list({str(bbox.surface_id) for bbox in bboxes})
+        if not surface_ids:
+            return []
+        query = session.query(model)
+        query = query.filter(model.surface_id.in_(surface_ids))
+        cutoff = policy.cutoff()
+        if cutoff is not None:
+            query = query.filter(model.created_at >= cutoff)
+        return query.all()
+
+    def _filter_uncached(self, bboxes: List, cached_images: List) -> List:
+        cached_surface_ids = {str(image.surface_id) for image in cached_images}
+        return [bbox for bbox in bboxes if str(bbox.surface_id) not in cached_surface_ids]
+
+    def _delete_surface_images(self, session: Session, model: BaseTable, recordings: List) -> None:
+        surface_ids = list({str(recording.surface_id) for recording in recordings if recording is not None})
+        if surface_ids:
+            session.query(model).filter(model.surface_id.in_(surface_ids)).delete(synchronize_session=False)
+
+    def _upsert(
+        self,
+        session: Session,
+        model: BaseTable,
+        recordings: List,
+        index_elements: List[str],
+        chunk_size: int
+    ) -> int:
+        """
+        Inserts the recordings with INSERT ... ON CONFLICT DO NOTHING in chunks,
+        duplicates within the recordings are dropped before they are sent to the db.
+        Returns the amount of inserted rows.
+        """
+        rows = []
+        seen_keys = set()
+        for recording in recordings:
+            if recording is None:
+                continue
+            row = {field.name: getattr(recording, field.name) for field in fields(recording)}
+            if isinstance(row.get("image"), RasterImage):
+                # cropped images are encoded here, once
+                row["image"] = row["image"].encode()
+            key = tuple(str(row[element]) for element in index_elements)
+            if key in seen_keys:
+                continue
+            seen_keys.add(key)
+            rows.append(row)
+
+        inserted = 0
+        for start in range(0, len(rows), chunk_size):
+            statement = insert(model.__table__).values(rows[start:start + chunk_size])
+            statement = statement.on_conflict_do_nothing(index_elements=index_elements)
+            inserted += session.execute(statement).rowcount
+        return inserted
+
+    def _collect_surfaces(self, bag_building_id: str = None, session: Session = None):
         """
         returns all surfaces belonging to a building
         """
-        with self.session_factory.build() as session:
+        with self.session_factory.reuse(session) as session:
             query = session.query(Surface_dataclass)
             query = query.where(bag_building_id == Surface_dataclass.bag_building_id)
             res = query.all()
@@ -97,11 +341,11 @@ class BagCollector(Collector):
                 raise NoDataFound("surface ids with specified bag building id not found!")
             return res
     
-    def _collect_surface_ids(self, bag_building_id: str = None):
+    def _collect_surface_ids(self, bag_building_id: str = None, session: Session = None):
         """
         returns all surfaces belonging to a building
         """
-        with self.session_factory.build() as session:
+        with self.session_factory.reuse(session) as session:
             query = session.query(Surface_dataclass.id)
             query = query.where(bag_building_id == Surface_dataclass.bag_building_id)
             res = query.all()
@@ -110,8 +354,8 @@ class BagCollector(Collector):
             return res
     
 
-    def _collect_images(self, surface_ids: List, model: Image):
-        with self.session_factory.build() as session:
+    def _collect_images(self, surface_ids: List, model: Image, session: Session = None):
+        with self.session_factory.reuse(session) as session:
             query = session.query(model)
             query = query.filter(model.surface_id.in_(surface_ids))
             res = query.all()
@@ -120,6 +364,15 @@ class BagCollector(Collector):
             return res
     
 
-    def _transform_to_wkt(self, building: Building_dataclass) -> None:
-        for surface in building.surfaces:
-            surface.surface_geometry = to_shape(surface.surface_geometry)
\ No newline at end of file
+    def _decode_geometries(self, wkb_geometries: List) -> List:
+        """
+        Decodes a list of WKB geometries into shapely geometries in one go.
+        Shapely 2 decodes the whole array in C. Shapely 1.8 has no array functions,
+        there one GEOS WKB reader decodes the list, wkb.loads would create a reader per geometry.
+        """
+        if not wkb_geometries:
+            return []
+        if vectorized_from_wkb is not None:
+            return list(vectorized_from_wkb(np.array([bytes(geometry) for geometry in wkb_geometries], dtype=object)))
+        reader = WKBReader(lgeos)
+        return [reader.read(bytes(geometry)) for geometry in wkb_geometries]
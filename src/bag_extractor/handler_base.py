@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import logging
+from typing import Iterator
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -31,19 +33,63 @@ class Collector(ABC):
     
 
 class SessionHandler:
+    """
+    Holds the engine and one session factory for the lifetime of the handler.
+
+    The engine uses a connection pool by default, configurable through the environment:
+    db_pool_size, db_max_overflow, db_pool_pre_ping (true/false) and db_pool_recycle (seconds).
+    Set db_pool_size to 0 to fall back to opening a connection per session (NullPool).
+    """
     engine = None
 
-    def __init__(self, echo=False):
+    def __init__(
+        self,
+        echo=False,
+        pool_size: int = None,
+        max_overflow: int = None,
+        pool_pre_ping: bool = None,
+        pool_recycle: int = None
+    ):
         load_dotenv()
 
         user = getenv('user')
         host = getenv('host')
         name = getenv('dbname')
+
+        pool_size = pool_size if pool_size is not None else int(getenv('db_pool_size', 5))
+        max_overflow = max_overflow if max_overflow is not None else int(getenv('db_max_overflow', 10))
+        pool_pre_ping = pool_pre_ping if pool_pre_ping is not None else \
+            getenv('db_pool_pre_ping', 'true').lower() == 'true'
+        pool_recycle = pool_recycle if pool_recycle is not None else int(getenv('db_pool_recycle', 1800))
+
+        if pool_size > 0:
+            pool_arguments = {
+                "pool_size": pool_size,
+                "max_overflow": max_overflow,
+                "pool_pre_ping": pool_pre_ping,
+                "pool_recycle": pool_recycle
+            }
+        else:
+            pool_arguments = {"poolclass": NullPool}
+
         self.engine = create_engine(
             f'postgresql://{user}:@{host}/{name}',
-            poolclass=NullPool,
-            echo=echo
+            echo=echo,
+            **pool_arguments
         )
+        self._session_maker = sessionmaker(bind=self.engine)
 
     def build(self) -> Session:
-        return sessionmaker(bind=self.engine)()
+        return self._session_maker()
+
+    @contextmanager
+    def reuse(self, session: Session = None) -> Iterator[Session]:
+        """
+        Yields the supplied session, or builds (and closes) a new one when none is supplied.
+        This lets a caller share one session over several reads.
+        """
+        if session is not None:
+            yield session
+            return
+        with self.build() as new_session:
+            yield new_session
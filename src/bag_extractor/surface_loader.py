@@ -0,0 +1,206 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from os import getenv
+from typing import Dict, List, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from src.bag_extractor.handler_base import SessionHandler
+from models.dataclass_mappings.image import AerialImage, StreetviewImage
+from models.dataclass_mappings.panorama import Panorama
+
+CHECKPOINT_TABLE = '"data".surface_load_partitions'
+
+# the stored images refer to the surface ids, which are generated again by a restart.
+IMAGE_TABLES = [model.__table__.fullname for model in (Panorama, StreetviewImage, AerialImage)]
+
+# the secondary indexes of sql/surfaces.sql, dropped while loading and built once all partitions are loaded.
+SURFACE_INDEXES = {
+    'surfaces_3d_bag_building_ids_covering':
+        'CREATE INDEX IF NOT EXISTS surfaces_3d_bag_building_ids_covering '
+        'ON "data".surfaces (bag_building_id) INCLUDE (id, semantics_value)',
+    'idx_surfaces_surface_geometry':
+        'CREATE INDEX IF NOT EXISTS idx_surfaces_surface_geometry ON "data".surfaces USING gist (surface_geometry)',
+}
+
+# the statement of sql/surfaces.sql, for the lod22 rows of one fid range.
+INSERT_PARTITION = text("""
+insert into "data".surfaces (id, bag_building_id, semantics_value, surface_type, surface_geometry)
+with unnested_surfaces as (
+select uuid_generate_v4() as uuid
+, fid
+, unnest(semantics_values) as semantics_value
+, (ST_DUMP(geometrie)).geom as geom
+from bag3d.lod22_3d
+where fid >= :fid_from and fid < :fid_to)
+select uuid
+, split_part(pand.identificatie, '.', 4) as bag_building_id
+, semantics_value
+, case when semantics_value::int = 0 then 'GroundSurface'
+    when semantics_value::int = 1 then 'RoofSurface'
+    when semantics_value::int = 2 then 'OuterWallSurface'
+    when semantics_value::int = 3 then 'InnerWallSurface'
+end as surface_type
+, st_transform(geom, 28992) as surface_geometry -- dutch (Amersfoort) CRS.
+from unnested_surfaces
+join bag3d.pand on
+unnested_surfaces.fid = pand.fid
+""")
+
+
+@dataclass
+class LoadResult:
+    """
+    Outcome of a surface load, failed holds the fid range of a partition with the reason.
+    """
+    loaded: Dict[Tuple[int, int], int] = field(default_factory=dict)
+    skipped: List[Tuple[int, int]] = field(default_factory=list)
+    failed: Dict[Tuple[int, int], str] = field(default_factory=dict)
+    indexed: bool = False
+
+
+class SurfaceLoader:
+    """
+    Fills data.surfaces from bag3d.lod22_3d in fid range partitions, loaded in parallel on their own connections.
+
+    Every partition is inserted and checkpointed in one transaction, a failed or interrupted partition
+    leaves nothing behind and the next run only loads the partitions without a checkpoint.
+    The secondary indexes are dropped before loading and built (followed by an ANALYZE) once every partition is loaded.
+
+    Configurable through the environment: surface_load_partition_size (fids per partition)
+    and surface_load_workers (parallel connections).
+    """
+
+    def __init__(self, partition_size: int = None, workers: int = None) -> None:
+        self.logger = logging.getLogger(__name__)
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(levelname)s-%(threadName)s: %(message)s'
+        )
+
+        # the settings can come from the .env file, SessionHandler loads it too late for them.
+        load_dotenv()
+        self.partition_size = partition_size or int(getenv('surface_load_partition_size', 50000))
+        self.workers = workers or int(getenv('surface_load_workers', 4))
+        # one connection per worker, plus one for the bookkeeping.
+        self.session_factory = SessionHandler(pool_size=self.workers + 1, max_overflow=0)
+
+    def load(self, restart: bool = False) -> LoadResult:
+        """
+        Loads the partitions without a checkpoint, or all of them after a restart.
+        A restart empties data.surfaces and deletes every stored streetview, panorama and aerial image,
+        those refer to the old surface ids and the surfaces get new ones.
+        """
+        result = LoadResult()
+        with self.session_factory.engine.begin() as connection:
+            self._prepare_checkpoints(connection, restart)
+            partitions = self._partitions(connection)
+            completed = self._completed_partitions(connection)
+
+        pending = [partition for partition in partitions if partition not in completed]
+        result.skipped = [partition for partition in partitions if partition in completed]
+        self.logger.info(
+            f"{len(partitions)} partitions of {self.partition_size} fids, "
+            f"{len(result.skipped)} already loaded, {len(pending)} to load"
+        )
+
+        if pending:
+            with self.session_factory.engine.begin() as connection:
+                self._drop_indexes(connection)
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='surfaces') as executor:
+                futures = {executor.submit(self.load_partition, *partition): partition for partition in pending}
+                for future in as_completed(futures):
+                    partition = futures[future]
+                    try:
+                        result.loaded[partition] = future.result()
+                    except Exception as e:
+                        self.logger.error(f"partition {partition[0]}-{partition[1]} failed: {e}")
+                        result.failed[partition] = str(e)
+                        continue
+                    done = len(result.loaded) + len(result.failed)
+                    self.logger.info(
+                        f"partition {partition[0]}-{partition[1]}: {result.loaded[partition]} surfaces "
+                        f"({done}/{len(pending)})"
+                    )
+
+        if result.failed:
+            self.logger.warning(
+                f"{len(result.failed)} partitions failed, run the load again to resume, the indexes are built after"
+            )
+        else:
+            self.build_indexes()
+            result.indexed = True
+        return result
+
+    def load_partition(self, fid_from: int, fid_to: int) -> int:
+        """
+        Inserts the surfaces of the lod22 rows with fid_from <= fid < fid_to and checkpoints the partition,
+        both in one transaction.
+        """
+        with self.session_factory.engine.begin() as connection:
+            inserted = connection.execute(INSERT_PARTITION, {"fid_from": fid_from, "fid_to": fid_to}).rowcount
+            connection.execute(
+                text(
+                    f"insert into {CHECKPOINT_TABLE} (fid_from, fid_to, partition_size, surfaces) "
+                    "values (:fid_from, :fid_to, :partition_size, :surfaces)"
+                ),
+                {"fid_from": fid_from, "fid_to": fid_to, "partition_size": self.partition_size, "surfaces": inserted}
+            )
+        return inserted
+
+    def build_indexes(self) -> None:
+        with self.session_factory.engine.begin() as connection:
+            for name, statement in SURFACE_INDEXES.items():
+                self.logger.info(f"building index {name}")
+                connection.execute(text(statement))
+            connection.execute(text('ANALYZE "data".surfaces'))
+
+    def _prepare_checkpoints(self, connection: Connection, restart: bool) -> None:
+        connection.execute(text(
+            f"create table if not exists {CHECKPOINT_TABLE} ("
+            "fid_from bigint primary key, "
+            "fid_to bigint not null, "
+            "partition_size bigint not null, "
+            "surfaces bigint not null, "
+            "completed_at timestamptz not null default now())"
+        ))
+        if restart:
+            self.logger.info(f"restarting, emptying data.surfaces and {', '.join(IMAGE_TABLES)}")
+            # no cascade, any other table referring to the surfaces makes the truncate fail instead of emptying it.
+            connection.execute(text(f'truncate {CHECKPOINT_TABLE}, "data".surfaces, {", ".join(IMAGE_TABLES)}'))
+            return
+
+        sizes = connection.execute(text(f"select distinct partition_size from {CHECKPOINT_TABLE}")).scalars().all()
+        if not sizes and connection.execute(text('select exists (select from "data".surfaces)')).scalar():
+            raise ValueError("data.surfaces holds surfaces without checkpoints, restart the load to replace them")
+        if sizes and sizes != [self.partition_size]:
+            raise ValueError(
+                f"the checkpoints were made with a partition size of {sizes[0]}, "
+                f"resume with that partition size or restart the load"
+            )
+
+    def _partitions(self, connection: Connection) -> List[Tuple[int, int]]:
+        first_fid, last_fid = connection.execute(text("select min(fid), max(fid) from bag3d.lod22_3d")).one()
+        if first_fid is None:
+            return []
+        # aligned on multiples of the partition size, so the ranges are the same on every run.
+        start = first_fid - first_fid % self.partition_size
+        return [
+            (fid_from, fid_from + self.partition_size)
+            for fid_from in range(start, last_fid + 1, self.partition_size)
+        ]
+
+    def _completed_partitions(self, connection: Connection) -> set:
+        rows = connection.execute(text(f"select fid_from, fid_to from {CHECKPOINT_TABLE}")).all()
+        return {(fid_from, fid_to) for fid_from, fid_to in rows}
+
+    def _drop_indexes(self, connection: Connection) -> None:
+        """
+        Also drops the plain bag_building_id index (replaced by the covering one)
+        and the index on id, which duplicates the primary key and isn't created anymore.
+        """
+        for name in (*SURFACE_INDEXES, 'surfaces_3d_bag_building_ids', 'surfaces_3d_id'):
+            connection.execute(text(f'drop index if exists "data".{name}'))
@@ -1,8 +1,16 @@
+import sys
+from typing import Iterator, TextIO
+
 import click
+from psycopg2.errors import NoDataFound
 from src.bag_extractor.db_handler import BagCollector
-from src.image_extractor.image_collector import ImageCollector
-from src.polygon_calculator.surface_calculator import SurfaceCalculator
-from src.model_generator.cityjson_generator import CityJSONGenerator
+from src.bag_extractor.surface_loader import SurfaceLoader
+from src.model_generator.cityjson_seq_writer import CityJSONSeqWriter
+from src.model_generator.cityjson_tile_generator import CityJSONTileGenerator
+from src.model_generator.model_generator import create_model_generator
+from src.model_generator.result_cache import ResultCache
+from src.model_generator.texture_atlas import TextureAtlasPacker
+from src.pipeline.batch_pipeline import BatchPipeline
 
 cli_group = click.Group()
 
@@ -23,54 +31,215 @@ def collect_and_generate_cityjson(bag_building_id: str):
 
     """
 
+    pipeline = BatchPipeline(workers=1)
+    try:
+        pipeline.process_building(bag_building_id)
+    except NoDataFound as e:
+        pipeline.logger.warning(e)
+        sys.exit(0)
+    finally:
+        pipeline.image_collector.close()
+        pipeline.surface_calculator.close()
+        pipeline.model_generator.image_writer.close()
+
+
+@cli_group.command()
+@click.option("-bag_id", "--bag_building_id", type=str, required=False, default=None)
+@click.option("-g", "--generator", type=click.Choice(['cjio', 'direct']), required=False, default='direct',
+              help="direct writes shared, indexed vertices without cjio, cjio builds the model with cjio")
+@click.option("-atlas", "--texture_atlas", is_flag=True, default=False,
+              help="pack the textures of a building into atlas images, not supported by --generator=cjio")
+def generate_cityjson_from_db(bag_building_id: str, generator: str, texture_atlas: bool):
+
     bag_collector = BagCollector()
-    surface_calculator = SurfaceCalculator()
-    image_collector = ImageCollector()
-    model_generator = CityJSONGenerator()
-
-    # collect the selected bag data and polygons
-    building = bag_collector.collect_building(bag_building_id)
-    outer_wall_bboxes, roof_bboxes = surface_calculator.calculate_surface_bounding_boxes(building)
-    panoramas, streetview_images, aerial_images = image_collector.collect_images(outer_wall_bboxes, roof_bboxes)
-    cropped_roof_images = surface_calculator.process_roof_images(building=building, images=aerial_images)
-
-    bag_collector.store_streetview(panoramas, streetview_images)
-    bag_collector.store_aerial(cropped_roof_images=cropped_roof_images)
-
-    # still busy with trying to model, WIP.
-    cm = model_generator.generate(
-        building=building,
-        textures_enabled=True
-    )
+    model_generator = _create_model_generator(generator, texture_atlas)
+
+    try:
+        result_cache = ResultCache()
+
+        building = bag_collector.collect_building(bag_building_id)
+        streetview_images, cropped_roof_images = bag_collector.collect_images(bag_building_id)
+        images = streetview_images + cropped_roof_images
+
+        cache_key = None
+        if result_cache.enabled:
+            cache_key = result_cache.key(
+                building=building,
+                images=images,
+                generator_parameters=model_generator.cache_parameters(),
+                textures_enabled=True
+            )
+            if result_cache.is_current(building.id, 'prototype_portfolio', cache_key):
+                click.echo(f"{bag_building_id}: output is up to date")
+                return
+
+        cm = model_generator.generate(
+            building=building,
+            textures_enabled=True
+        )
+
+        model_generator.save(
+            building=building,
+            images=images,
+            cm=cm,
+            filename='prototype_portfolio',
+            cache_key=cache_key
+        )
+    finally:
+        model_generator.image_writer.close()
 
-    model_generator.save(
-        building=building,
-        images=streetview_images + cropped_roof_images,
-        cm=cm,
-        filename='prototype_portfolio'
+
+@cli_group.command()
+@click.option("-bag_ids", "--bag_ids_file", type=click.File("r"), required=False, default=None,
+              help="file with one bag building id per line, use - for stdin")
+@click.option("-prefix", "--bag_id_prefix", type=str, required=False, default=None,
+              help="process all bag building ids starting with this prefix, e.g. a municipality code")
+@click.option("-w", "--workers", type=int, required=False, default=4)
+@click.option("-iw", "--image_workers", type=int, required=False, default=10)
+@click.option("-o", "--output_dir", type=str, required=False, default='')
+@click.option("-seq", "--cityjsonseq", type=click.File("w"), required=False, default=None,
+              help="stream all buildings into one CityJSON text sequence (.city.jsonl) instead of a file per building")
+@click.option("-g", "--generator", type=click.Choice(['cjio', 'direct']), required=False, default='direct',
+              help="direct writes shared, indexed vertices without cjio, cjio builds the model with cjio")
+@click.option("-atlas", "--texture_atlas", is_flag=True, default=False,
+              help="pack the textures of a building into atlas images, not supported by --generator=cjio")
+def collect_and_generate_cityjson_batch(
+    bag_ids_file: TextIO,
+    bag_id_prefix: str,
+    workers: int,
+    image_workers: int,
+    output_dir: str,
+    cityjsonseq: TextIO,
+    generator: str,
+    texture_atlas: bool
+):
+    """
+    Runs the calculation process for many buildings in one process,
+    reusing the database engine, WMS service and worker pools.
+
+    example: python -m src.cli collect-and-generate-cityjson-batch --bag_ids_file=- < ids.txt
+    """
+    if bag_ids_file is None and bag_id_prefix is None:
+        raise click.UsageError("supply either --bag_ids_file or --bag_id_prefix")
+    if texture_atlas and cityjsonseq is not None:
+        raise click.UsageError("--texture_atlas can't be combined with --cityjsonseq")
+    model_generator = _create_model_generator(generator, texture_atlas)
+
+    pipeline = BatchPipeline(
+        workers=workers,
+        image_workers=image_workers,
+        output_dir=output_dir,
+        seq_writer=CityJSONSeqWriter(cityjsonseq) if cityjsonseq is not None else None,
+        model_generator=model_generator
     )
 
+    if bag_ids_file is not None:
+        bag_building_ids = _read_bag_ids(bag_ids_file)
+    else:
+        bag_building_ids = pipeline.bag_collector.collect_building_ids(bag_id_prefix)
+
+    result = pipeline.run(bag_building_ids)
+    if pipeline.seq_writer is not None:
+        pipeline.seq_writer.close()
+    if result.failed:
+        raise SystemExit(1)
+
 
 @cli_group.command()
-@click.option("-bag_id", "--bag_building_id", type=str, required=False, default=None)
-def generate_cityjson_from_db(bag_building_id: str):
+@click.option("-bbox", "--bbox", type=str, required=False, default=None,
+              help="EPSG:28992 area as x_min,y_min,x_max,y_max")
+@click.option("-tile", "--tile_id", type=int, required=False, default=None,
+              help="fid of a tile in the bag3d grid table")
+@click.option("-o", "--output_dir", type=str, required=False, default='')
+@click.option("-f", "--filename", type=str, required=False, default=None,
+              help="name of the tile file, defaults to tile_<tile id> or tile_<x min>_<y min>")
+@click.option("-atlas", "--texture_atlas", is_flag=True, default=False,
+              help="pack the textures of the tile into atlas images")
+def generate_cityjson_tile(bbox: str, tile_id: int, output_dir: str, filename: str, texture_atlas: bool):
+    """
+    Generates one CityJSON file for all buildings intersecting an area,
+    with the surfaces and images stored in the database.
+
+    example: python -m src.cli generate-cityjson-tile --bbox=92000,437000,92500,437500 --output_dir=tiles
+    """
+    if (bbox is None) == (tile_id is None):
+        raise click.UsageError("supply either --bbox or --tile_id")
+    if bbox is not None:
+        try:
+            bbox = [float(value) for value in bbox.split(',')]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4:
+            raise click.UsageError("--bbox needs four numbers: x_min,y_min,x_max,y_max")
+    if filename is None:
+        filename = f"tile_{tile_id}" if tile_id is not None else f"tile_{bbox[0]:.0f}_{bbox[1]:.0f}"
 
     bag_collector = BagCollector()
-    model_generator = CityJSONGenerator()
+    tile_generator = CityJSONTileGenerator(texture_atlas=TextureAtlasPacker() if texture_atlas else None)
+    try:
+        with bag_collector.session_factory.build() as session:
+            buildings = bag_collector.collect_buildings_in_area(bbox=bbox, tile_id=tile_id, session=session)
+            surface_ids = [surface.id for building in buildings for surface in building.surfaces]
+            images = bag_collector.collect_surface_images(surface_ids, session=session)
+        if not buildings:
+            bag_collector.logger.warning("no buildings found in the area")
+            sys.exit(0)
+
+        tile = tile_generator.generate_tile(buildings=buildings, textures_enabled=True)
+        tile_generator.save_tile(buildings=buildings, images=images, tile=tile, filename=filename, output_dir=output_dir)
+        bag_collector.logger.info(f"wrote {len(buildings)} buildings to {filename}.json")
+    finally:
+        tile_generator.image_writer.close()
 
-    building = bag_collector.collect_building(bag_building_id)
-    streetview_images, cropped_roof_images = bag_collector.collect_images(bag_building_id)
-    cm = model_generator.generate(
-        building=building,
-        textures_enabled=True
-    )
 
-    model_generator.save(
-        building=building,
-        images=streetview_images + cropped_roof_images,
-        cm=cm,
-        filename='prototype_portfolio'
+@cli_group.command()
+@click.option("-size", "--partition_size", type=int, required=False, default=None,
+              help="lod22 fids per partition, defaults to surface_load_partition_size or 50000")
+@click.option("-w", "--workers", type=int, required=False, default=None,
+              help="partitions loaded in parallel, defaults to surface_load_workers or 4")
+@click.option("--restart", is_flag=True, default=False,
+              help="empty data.surfaces, delete ALL stored streetview, panorama and aerial images "
+                   "and load every partition again")
+@click.option("-y", "--yes", is_flag=True, default=False, help="don't ask to confirm a restart")
+def load_surfaces(partition_size: int, workers: int, restart: bool, yes: bool):
+    """
+    Fills data.surfaces from bag3d.lod22_3d in parallel partitions,
+    an interrupted or failed load resumes at the partitions that weren't loaded yet.
+
+    example: python -m src.cli load-surfaces --workers=8
+    """
+    if restart and not yes:
+        click.confirm(
+            "A restart empties data.surfaces and deletes all stored streetview, panorama and aerial images, "
+            "the surfaces get new ids. Continue?",
+            abort=True
+        )
+    surface_loader = SurfaceLoader(partition_size=partition_size, workers=workers)
+    try:
+        result = surface_loader.load(restart=restart)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    surface_loader.logger.info(
+        f"load done: {sum(result.loaded.values())} surfaces in {len(result.loaded)} partitions, "
+        f"{len(result.skipped)} skipped, {len(result.failed)} failed"
     )
+    if result.failed:
+        raise SystemExit(1)
+
+
+def _create_model_generator(generator: str, texture_atlas: bool):
+    try:
+        return create_model_generator(generator, texture_atlas=texture_atlas)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+def _read_bag_ids(bag_ids_file: TextIO) -> Iterator[str]:
+    for line in bag_ids_file:
+        bag_building_id = line.strip()
+        if bag_building_id and not bag_building_id.startswith('#'):
+            yield bag_building_id
+
 
 if __name__ == "__main__":
     cli_group()
@@ -0,0 +1,29 @@
+from dataclasses import dataclass
+from typing import Any
+import uuid
+
+
+@dataclass
+class FetchResult:
+    """
+    Outcome of fetching an image for a single surface.
+    value holds what the service returned on success, error the reason it failed otherwise.
+    """
+    surface_id: uuid
+    service: str
+    value: Any = None
+    error: str = None
+    status_code: int = None
+    attempts: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def transient(self) -> bool:
+        """
+        A failure which can succeed later: given up retries, throttling or a server error.
+        A client error, like a streetview 400 for a surface it can't render, fails again every time.
+        """
+        return not self.ok and (self.status_code is None or self.status_code == 429 or self.status_code >= 500)
@@ -0,0 +1,73 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from os import getenv
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def build_http_session(pool_size: int = 10) -> requests.Session:
+    """
+    Builds a keep-alive session shared by the image services,
+    with a connection pool large enough for all fetching threads
+    and the cyclomedia credentials from the environment.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.auth = requests.auth.HTTPBasicAuth(getenv('cyclomedia_username'), getenv('cyclomedia_password'))
+    return session
+
+
+def request_timeout() -> Tuple[float, float]:
+    """
+    (connect, read) timeout in seconds for the image requests, from http_connect_timeout and http_read_timeout.
+    A stalled connection then raises a Timeout, which is retried, instead of hanging a fetching thread.
+    """
+    return float(getenv('http_connect_timeout', 10)), float(getenv('http_read_timeout', 60))
+
+
+class ThrottledError(requests.exceptions.RetryError):
+    """
+    Raised when a service asks to slow down (429) or is temporarily unavailable (502, 503, 504).
+    retry_after holds the seconds the service asked to wait, if it did.
+    """
+
+    def __init__(self, message: str, retry_after: float = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+
+
+def raise_for_throttling(resp: requests.Response) -> None:
+    """
+    Raises a ThrottledError for the status codes that are worth retrying.
+    """
+    if resp.status_code in RETRYABLE_STATUS_CODES:
+        raise ThrottledError(
+            f"got a {resp.status_code} from {resp.url}",
+            retry_after=parse_retry_after(resp.headers.get('Retry-After'))
+        )
+
+
+def parse_retry_after(value: str) -> Optional[float]:
+    """
+    Retry-After is either an amount of seconds or an http date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
@@ -1,13 +1,18 @@
+import logging
+from dataclasses import replace
 from time import sleep
-from typing import List, Union
-from concurrent.futures import ProcessPoolExecutor
-from requests.exceptions import HTTPError, RetryError
+from typing import Any, Callable, List, Union
+from requests.exceptions import ConnectionError, RequestException, RetryError, Timeout
 
+from src.image_extractor.fetch_result import FetchResult
+from src.image_extractor.http_session import build_http_session
+from src.image_extractor.rate_limiter import RetryPolicy, TokenBucket
 from src.image_extractor.streetviewservice.streetview_service import StreetviewService
 from src.image_extractor.wmsservice.wmsservice import WMSService
+from src.worker_pool import WorkerPool
 
 from models.dataclass_mappings.bounding_box import BoundingBox
-from models.dataclass_mappings.image import Aerial_Image_dataclass, Streetview_Image_dataclass
+from models.dataclass_mappings.image import Streetview_Image_dataclass
 from models.dataclass_mappings.panorama import Panorama_dataclass
 
 
@@ -15,21 +20,47 @@ class ImageCollector:
     """
     This class calculates the best position to download an image from
     and also downloads the images and stores them on s3/the database.
+
+    Fetching is network bound, so streetview and aerial requests are scheduled
+    on one thread pool and share one keep-alive http session.
     """
 
-    def __init__(self) -> None:
-        self.streetviewService = StreetviewService()
-        self.wmsService = WMSService()
+    def __init__(self, workers: int = 10, shared_aerial_tiles: bool = True, max_tile_extent: float = 200.0) -> None:
+        """
+        With shared_aerial_tiles, the roofs of one collect_images call lying close together are fetched
+        as one aerial image of at most max_tile_extent meters wide and high, instead of one image per roof.
+        The pipelines call it per building, so only the roofs of one building share an image,
+        neighbouring buildings share downloads through the WMS tile cache instead.
+        """
+        self.workers = workers
+        self.shared_aerial_tiles = shared_aerial_tiles
+        self.max_tile_extent = max_tile_extent
+        self.session = build_http_session(pool_size=workers)
+        # every service has its own quota, the retry policy is shared.
+        self.streetview_limiter = TokenBucket.from_env('cyclomedia_streetview', default_rate=5)
+        self.wms_limiter = TokenBucket.from_env('cyclomedia_wms', default_rate=5)
+        self.retry_policy = RetryPolicy()
+
+        self.streetviewService = StreetviewService(session=self.session)
+        # the wms service takes a token per GetMap itself, a request can need several (uncached) tiles.
+        self.wmsService = WMSService(session=self.session, limiter=self.wms_limiter)
+        self.logger = logging.getLogger(__name__)
+
+        # the pool is kept alive between calls, so batch runs don't pay for a spin-up per building.
+        self._pool = WorkerPool(workers, thread_name_prefix='image')
+
+    def close(self) -> None:
+        self._pool.close()
 
     def collect_images(
         self,
         outer_wall_bboxes: List,
         roof_bboxes: List,
-        workers: int = 5,
-    ) -> Union[List, List, List]:
+    ) -> Union[List, List, List, List]:
         """
         Iterates through the bounding boxes and sends a request to {api}
-        to get an image or metadata
+        to get an image or metadata.
+        Surfaces for which no image could be fetched are returned as failed FetchResults.
 
         available API's in this code at the moment:
         - Cyclomedia Streetview
@@ -38,62 +69,143 @@ class ImageCollector:
 
         panoramas = []
         streetview_images = []
-
-        with ProcessPoolExecutor(max_workers=workers) as streetview_pool:
-            streetview_pool_results = streetview_pool.map(self._get_streetview_images, outer_wall_bboxes)
-
-        with ProcessPoolExecutor(max_workers=workers) as streetview_pool:
-            aerial_images = streetview_pool.map(self._get_aerial_images, roof_bboxes)
+        aerial_images = []
+        failures = []
+
+        # submit both services at once, so the aerial requests don't wait for the streetview ones.
+        pool = self._pool
+        streetview_futures = [pool.submit(self._get_streetview_images, bbox) for bbox in outer_wall_bboxes]
+        if self.shared_aerial_tiles:
+            roof_groups = self._group_roof_bboxes(roof_bboxes)
+            aerial_futures = [pool.submit(self._get_aerial_tile, roof_group) for roof_group in roof_groups]
+        else:
+            roof_groups = [[bbox] for bbox in roof_bboxes]
+            aerial_futures = [pool.submit(self._get_aerial_images, bbox) for bbox in roof_bboxes]
 
         panorama_recording: Panorama_dataclass
         streetview_image_recording: Streetview_Image_dataclass
 
         # since we return a union, we need to split the results.
-        for panorama_recording, streetview_image_recording in streetview_pool_results:
+        for future in streetview_futures:
+            result = future.result()
+            if not result.ok:
+                failures.append(result)
+                continue
+            panorama_recording, streetview_image_recording = result.value
             panoramas.append(panorama_recording)
             streetview_images.append(streetview_image_recording)
 
-        return panoramas, streetview_images, list(aerial_images)
+        for future, roof_group in zip(aerial_futures, roof_groups):
+            result = future.result()
+            if not result.ok:
+                # a failed tile means a failure for every roof it covers
+                failures.extend(replace(result, surface_id=bbox.surface_id) for bbox in roof_group)
+                continue
+            aerial_images.append(result.value)
 
-    def _get_streetview_images(
-        self,
-        bbox: BoundingBox
-    ) -> Union[Panorama_dataclass, Streetview_Image_dataclass]:
-        bbox: BoundingBox
-        attempt = 0
+        return panoramas, streetview_images, aerial_images, failures
 
-        for attempt in range(3):
-            try:
-                print(bbox.surface_id, attempt)
-                panorama_recording, image_recording = self.streetviewService.renderSurface(bbox)
+    def _group_roof_bboxes(self, roof_bboxes: List[BoundingBox]) -> List[List[BoundingBox]]:
+        """
+        Groups the roofs of one call from west to east, a roof joins the current group
+        as long as the union of the group stays within the max tile extent.
+        """
+        groups = []
+        group = []
+        union = None
+        for bbox in sorted(roof_bboxes, key=lambda bbox: bbox.lower_left.x):
+            extent = (bbox.lower_left.x, bbox.lower_left.y, bbox.upper_right.x, bbox.upper_right.y)
+            if union is not None:
+                candidate = (
+                    min(union[0], extent[0]),
+                    min(union[1], extent[1]),
+                    max(union[2], extent[2]),
+                    max(union[3], extent[3])
+                )
+                if candidate[2] - candidate[0] <= self.max_tile_extent and \
+                        candidate[3] - candidate[1] <= self.max_tile_extent:
+                    group.append(bbox)
+                    union = candidate
+                    continue
+                groups.append(group)
+            group = [bbox]
+            union = extent
+        if group:
+            groups.append(group)
+        return groups
+
+    def _get_streetview_images(self, bbox: BoundingBox) -> FetchResult:
+        """
+        value of a successful result is a (Panorama_dataclass, Streetview_Image_dataclass) tuple.
+        """
+        return self._fetch(
+            self.streetviewService.renderSurface, bbox, bbox.surface_id, self.streetview_limiter, 'streetview'
+        )
 
-            except RetryError as e:
-                print(e)
-                attempt += 1
-                continue
-            except HTTPError as e:
-                print(e)
-                return
-            else:
-                sleep(1)
-                return panorama_recording, image_recording
+    def _get_aerial_images(self, bbox: BoundingBox) -> FetchResult:
+        """
+        value of a successful result is an Aerial_Image_dataclass.
+        """
+        return self._fetch(
+            self.wmsService.request_image, bbox, bbox.surface_id, self.wms_limiter, 'aerial', acquire=False
+        )
+
+    def _get_aerial_tile(self, bboxes: List[BoundingBox]) -> FetchResult:
+        """
+        value of a successful result is an Aerial_Tile_dataclass covering all supplied roofs.
+        """
+        surface_ids = [bbox.surface_id for bbox in bboxes]
+        return self._fetch(
+            self.wmsService.request_tile, bboxes, surface_ids, self.wms_limiter, 'aerial', acquire=False
+        )
 
-    def _get_aerial_images(
+    def _fetch(
         self,
-        bbox: BoundingBox
-    ) -> Aerial_Image_dataclass:
-        for attempt in range(3):
+        request: Callable[[Any], Any],
+        target: Any,
+        surface_id: Any,
+        limiter: TokenBucket,
+        service: str,
+        acquire: bool = True
+    ) -> FetchResult:
+        """
+        Calls the request within the rate limit of the service,
+        throttling and connection errors are retried with backoff, other http errors fail directly.
+        Without acquire the request takes its own tokens, the limiter is then only paused on a Retry-After.
+        """
+        last_error = None
+        for attempt in range(1, self.retry_policy.attempts + 1):
+            if acquire:
+                limiter.acquire()
             try:
-                print(bbox.surface_id, attempt)
-                aerial_image = self.wmsService.request_image(bbox)
-
-            except RetryError as e:
-                print(e)
-                attempt += 1
-                continue
-            except HTTPError as e:
-                print(e)
-                return
+                value = request(target)
+            except (RetryError, ConnectionError, Timeout) as e:
+                last_error = e
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is not None:
+                    # the service asked everyone to wait, not only this request.
+                    limiter.pause(retry_after)
+                if attempt == self.retry_policy.attempts:
+                    self.logger.warning(f"{service} {surface_id} attempt {attempt}: {e}")
+                    break
+                delay = self.retry_policy.delay(attempt, retry_after)
+                self.logger.warning(f"{service} {surface_id} attempt {attempt}: {e}, retrying in {delay:.1f}s")
+                sleep(delay)
+            except RequestException as e:
+                self.logger.warning(f"{service} {surface_id}: {e}")
+                return FetchResult(
+                    surface_id=surface_id,
+                    service=service,
+                    error=str(e),
+                    status_code=e.response.status_code if e.response is not None else None,
+                    attempts=attempt
+                )
             else:
-                sleep(1)
-                return aerial_image
+                return FetchResult(surface_id=surface_id, service=service, value=value, attempts=attempt)
+
+        return FetchResult(
+            surface_id=surface_id,
+            service=service,
+            error=f"gave up after {self.retry_policy.attempts} attempts: {last_error}",
+            attempts=self.retry_policy.attempts
+        )
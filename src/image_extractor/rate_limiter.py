@@ -0,0 +1,69 @@
+import random
+from dataclasses import dataclass
+from os import getenv
+from threading import Lock
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket, every request takes one token
+    and tokens are refilled at a fixed rate (requests per second) up to the capacity.
+
+    A service can ask to back off (e.g. through Retry-After),
+    pause blocks every caller of the bucket until that moment has passed.
+    """
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._last_refill = monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    @classmethod
+    def from_env(cls, name: str, default_rate: float) -> 'TokenBucket':
+        """
+        Reads {name}_rate (requests per second) and {name}_burst from the environment.
+        """
+        rate = float(getenv(f'{name}_rate', default_rate))
+        burst = getenv(f'{name}_burst')
+        return cls(rate=rate, capacity=float(burst) if burst else None)
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available.
+        """
+        while True:
+            with self._lock:
+                now = monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                    self._last_refill = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, a Retry-After from the service takes precedence.
+    """
+    attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
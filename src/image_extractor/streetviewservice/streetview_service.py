@@ -1,4 +1,5 @@
 
+import logging
 from os import getenv
 from typing import List
 from shapely.geometry import Point
@@ -9,14 +10,25 @@ from models.dataclass_mappings.image import Streetview_Image_dataclass
 import requests
 from typing import Union
 
+from src.image_extractor.http_session import build_http_session, raise_for_throttling, request_timeout
+
 class StreetviewService:
 
-    def __init__(self) -> None:
+    def __init__(self, base_url: str = None, session: requests.Session = None, timeout: float = None) -> None:
+        """
+        The base url can be overridden (or set with cyclomedia_streetview_url) to point to a stub server.
+        Supply a session to share its connection pool with other services.
+        Without a timeout (in seconds) http_connect_timeout and http_read_timeout are used.
+        """
+        self.logger = logging.getLogger(__name__)
         self.googleKey = getenv("streetview_api_key")
         self.cyclomediaKey = getenv("cyclomedia_api_key")
-        self.cyclomediaStreetviewBase = 'https://atlas.cyclomedia.com/PanoramaRendering'
+        self.cyclomediaStreetviewBase = base_url or getenv(
+            "cyclomedia_streetview_url", 'https://atlas.cyclomedia.com/PanoramaRendering'
+        )
         self.cyclomediaAerialBase = ''
-        self.auth = requests.auth.HTTPBasicAuth(getenv('cyclomedia_username'), getenv('cyclomedia_password'))
+        self.session = session or build_http_session()
+        self.timeout = timeout or request_timeout()
 
     def renderSurface(self,
                       bbox: BoundingBox
@@ -51,12 +63,12 @@ class StreetviewService:
             "apiKey": self.cyclomediaKey,
             "margin": 0.1
         }
-        resp = requests.get(request_url, params=params, auth=self.auth)
-        print(resp)
-        if resp.status_code == 502:
-            raise requests.exceptions.RetryError("got a bad gateway from Cyclomedia")
+        resp = self.session.get(request_url, params=params, timeout=self.timeout)
+        self.logger.debug(f"{bbox.surface_id}: {resp.status_code}")
+        raise_for_throttling(resp)
         if resp.status_code == 400:
-            raise requests.exceptions.HTTPError("400 not found error, continuing.")
+            raise requests.exceptions.HTTPError("400 not found error, continuing.", response=resp)
+        resp.raise_for_status()
 
         image_id = uuid4()
 
@@ -0,0 +1,89 @@
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Optional
+
+
+class TileCache:
+    """
+    Stores aerial tiles of a fixed grid in a single sqlite file, comparable to mbtiles.
+    A tile is keyed on the layer, the tile size in meters, its size in pixels and its column and row in the grid,
+    so runs requesting another resolution (oversampling, max size) don't share tiles.
+
+    Aerial imagery of a layer doesn't change, so tiles never expire,
+    the least recently used tiles are evicted once the cache holds more than max_tiles.
+    """
+
+    def __init__(self, path: str, max_tiles: int = 20000) -> None:
+        self.path = path
+        self.max_tiles = max_tiles
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(tiles)")]
+        if columns and 'tile_pixels' not in columns:
+            # tiles of older caches don't record their pixel size, they are fetched again.
+            self._connection.execute("DROP TABLE tiles")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tiles (
+                layer TEXT NOT NULL,
+                tile_size REAL NOT NULL,
+                tile_pixels INTEGER NOT NULL,
+                tile_column INTEGER NOT NULL,
+                tile_row INTEGER NOT NULL,
+                image BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (layer, tile_size, tile_pixels, tile_column, tile_row)
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)")
+
+    def get(self, layer: str, tile_size: float, tile_pixels: int, tile_column: int, tile_row: int) -> Optional[bytes]:
+        key = (layer, tile_size, tile_pixels, tile_column, tile_row)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT image FROM tiles "
+                "WHERE layer = ? AND tile_size = ? AND tile_pixels = ? AND tile_column = ? AND tile_row = ?",
+                key
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE tiles SET last_access = ? "
+                "WHERE layer = ? AND tile_size = ? AND tile_pixels = ? AND tile_column = ? AND tile_row = ?",
+                (time(), *key)
+            )
+        return row[0]
+
+    def put(
+        self,
+        layer: str,
+        tile_size: float,
+        tile_pixels: int,
+        tile_column: int,
+        tile_row: int,
+        image: bytes
+    ) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO tiles "
+                "(layer, tile_size, tile_pixels, tile_column, tile_row, image, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (layer, tile_size, tile_pixels, tile_column, tile_row, image, time())
+            )
+            self._evict()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self) -> None:
+        count = self._connection.execute("SELECT count(*) FROM tiles").fetchone()[0]
+        if count <= self.max_tiles:
+            return
+        self._connection.execute(
+            "DELETE FROM tiles WHERE rowid IN (SELECT rowid FROM tiles ORDER BY last_access LIMIT ?)",
+            (count - self.max_tiles,)
+        )
@@ -1,10 +1,20 @@
+from math import ceil, floor
 from os import getenv
+import re
+from typing import List, Optional, Tuple
 from uuid import uuid4
+import numpy as np
 import requests
 from owslib.wms import WebMapService
+from rasterio import MemoryFile
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
 
+from src.image_extractor.http_session import build_http_session, raise_for_throttling, request_timeout
+from src.image_extractor.rate_limiter import TokenBucket
+from src.image_extractor.wmsservice.tile_cache import TileCache
 from models.dataclass_mappings.bounding_box import BoundingBox
-from models.dataclass_mappings.image import Aerial_Image_dataclass
+from models.dataclass_mappings.image import Aerial_Image_dataclass, Aerial_Tile_dataclass
 
 
 class WMSService:
@@ -18,18 +28,66 @@ class WMSService:
     - Cyclomedia: https://atlas.Cyclomedia.com/geodata/wms
     """
 
-    def __init__(self, srs: int = 28992, layer: str = 'NL_aerial_2021_10cm'):
-        self.wms = WebMapService(
-            url='https://atlas.Cyclomedia.com/geodata/wms?',
-            username=getenv("cyclomedia_username", None),
-            password=getenv("cyclomedia_password", None)
-        )
+    def __init__(
+        self,
+        srs: int = 28992,
+        layer: str = 'NL_aerial_2021_10cm',
+        url: str = None,
+        session: requests.Session = None,
+        gsd: float = None,
+        max_size: int = 4096,
+        oversampling: float = 1.0,
+        tile_cache: TileCache = None,
+        tile_size: float = 51.2,
+        limiter: TokenBucket = None,
+        timeout: float = None
+    ):
+        """
+        The url can be overridden (or set with cyclomedia_wms_url) to point to a stub server.
+        Supply a session to share its connection pool with other services.
+        Without a timeout (in seconds) http_connect_timeout and http_read_timeout are used.
+
+        The requested image size follows from the extent and the ground sample distance (gsd)
+        of the layer in meters per pixel, read from the layer name (e.g. 10cm) when not supplied.
+        oversampling > 1 requests more pixels than the layer holds,
+        the longest side is capped at max_size while keeping the aspect ratio.
+
+        With a tile cache (or wms_tile_cache_path set) requests are snapped to a grid of
+        tile_size meter tiles, tiles are fetched once and every extent is cut out of the cached tiles.
+
+        With a limiter every GetMap request takes a token, so an extent that needs several
+        uncached tiles takes a token per tile and one served from the cache takes none.
+        """
+        self.url = url or getenv('cyclomedia_wms_url', 'https://atlas.Cyclomedia.com/geodata/wms?')
         self.srs = srs
         self.layer = layer
-        self.width = 4096
-        self.height = 4096
+        self.gsd = gsd or self._gsd_from_layer(layer)
+        self.max_size = max_size
+        self.oversampling = oversampling
+
+        if tile_cache is None and getenv('wms_tile_cache_path'):
+            tile_cache = TileCache(getenv('wms_tile_cache_path'), max_tiles=int(getenv('wms_tile_cache_max_tiles', 20000)))
+        self.tile_cache = tile_cache
+        self.tile_size = tile_size
+
+        self.limiter = limiter
+        self.session = session or build_http_session()
+        self.timeout = timeout or request_timeout()
+        self._wms = None
 
-        self.auth = requests.auth.HTTPBasicAuth(getenv('cyclomedia_username'), getenv('cyclomedia_password'))
+    @property
+    def wms(self) -> WebMapService:
+        """
+        The capabilities of the service, only fetched when they are needed.
+        GetMap requests don't need them, they go through the shared session directly.
+        """
+        if self._wms is None:
+            self._wms = WebMapService(
+                url=self.url,
+                username=getenv("cyclomedia_username", None),
+                password=getenv("cyclomedia_password", None)
+            )
+        return self._wms
 
     def request_image(
         self,
@@ -40,26 +98,170 @@ class WMSService:
         the srs = 28992 as the srs of the database geometries in the project.
         the bounding_box is 4 points in lat/lon points.
         """
-        parameter_srs = f"EPSG:{self.srs}"
-        parameter_format = "image/tiff"
-
-        image = self.wms.getmap(
-            layers=[self.layer],
-            srs=parameter_srs,
-            format=parameter_format,
-            bbox=(
-                bbox.lower_left.x,
-                bbox.lower_left.y,
-                bbox.upper_right.x,
-                bbox.upper_right.y
-            ),
-            size=(self.height, self.width)
-        )
-
+        image, width, height = self._fetch_extent(self._extent(bbox))
         return Aerial_Image_dataclass(
             id=uuid4(),
             surface_id=bbox.surface_id,
-            image_height=self.height,
-            image_width=self.width,
-            image=image.read()
+            image_height=height,
+            image_width=width,
+            image=image
+        )
+
+    def request_tile(
+        self,
+        bboxes: List[BoundingBox],
+    ) -> Aerial_Tile_dataclass:
+        """
+        Requests one image covering all supplied bounding boxes,
+        so all roofs of a building can be cropped from a single download.
+        """
+        extents = [self._extent(bbox) for bbox in bboxes]
+        extent = (
+            min(extent[0] for extent in extents),
+            min(extent[1] for extent in extents),
+            max(extent[2] for extent in extents),
+            max(extent[3] for extent in extents)
         )
+        image, width, height = self._fetch_extent(extent)
+        return Aerial_Tile_dataclass(
+            id=uuid4(),
+            surface_ids=[bbox.surface_id for bbox in bboxes],
+            image_height=height,
+            image_width=width,
+            image=image
+        )
+
+    def _extent(self, bbox: BoundingBox) -> Tuple[float, float, float, float]:
+        return bbox.lower_left.x, bbox.lower_left.y, bbox.upper_right.x, bbox.upper_right.y
+
+    def _fetch_extent(self, extent: Tuple[float, float, float, float]) -> Tuple[bytes, int, int]:
+        """
+        Returns a GeoTIFF of the extent with its width and height, from the tile cache when enabled.
+        """
+        if self.tile_cache is not None and self.gsd is not None:
+            return self._get_cached_map(extent)
+        width, height = self._image_size(extent)
+        return self._get_map(extent, width, height), width, height
+
+    def _get_cached_map(self, extent: Tuple[float, float, float, float]) -> Tuple[bytes, int, int]:
+        """
+        Snaps the extent to the tile grid, puts the (cached) tiles together
+        and cuts the extent out of them again.
+        Grid rows count from the south, image rows from the north.
+        """
+        tile_pixels = min(self.max_size, max(1, round(self.tile_size / self.gsd * self.oversampling)))
+        resolution = self.tile_size / tile_pixels
+
+        first_column = floor(extent[0] / self.tile_size)
+        last_column = max(first_column, ceil(extent[2] / self.tile_size) - 1)
+        first_row = floor(extent[1] / self.tile_size)
+        last_row = max(first_row, ceil(extent[3] / self.tile_size) - 1)
+
+        mosaic = None
+        for column in range(first_column, last_column + 1):
+            for row in range(first_row, last_row + 1):
+                with MemoryFile(self._get_tile(column, row, tile_pixels)) as memfile:
+                    with memfile.open() as dataset:
+                        tile = dataset.read()
+                if mosaic is None:
+                    mosaic = np.zeros(
+                        (
+                            tile.shape[0],
+                            (last_row - first_row + 1) * tile_pixels,
+                            (last_column - first_column + 1) * tile_pixels
+                        ),
+                        dtype=tile.dtype
+                    )
+                x_offset = (column - first_column) * tile_pixels
+                y_offset = (last_row - row) * tile_pixels
+                mosaic[:, y_offset:y_offset + tile_pixels, x_offset:x_offset + tile_pixels] = \
+                    tile[:, :tile_pixels, :tile_pixels]
+
+        grid_left = first_column * self.tile_size
+        grid_top = (last_row + 1) * self.tile_size
+        left = floor((extent[0] - grid_left) / resolution)
+        right = max(left + 1, ceil((extent[2] - grid_left) / resolution))
+        top = floor((grid_top - extent[3]) / resolution)
+        bottom = max(top + 1, ceil((grid_top - extent[1]) / resolution))
+        cropped = mosaic[:, top:bottom, left:right]
+
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff",
+                height=cropped.shape[1],
+                width=cropped.shape[2],
+                count=cropped.shape[0],
+                dtype=cropped.dtype,
+                crs=CRS.from_epsg(self.srs),
+                transform=from_origin(grid_left + left * resolution, grid_top - top * resolution, resolution, resolution)
+            ) as dataset:
+                dataset.write(cropped)
+            return memfile.read(), cropped.shape[2], cropped.shape[1]
+
+    def _get_tile(self, column: int, row: int, tile_pixels: int) -> bytes:
+        tile = self.tile_cache.get(self.layer, self.tile_size, tile_pixels, column, row)
+        if tile is None:
+            tile_extent = (
+                column * self.tile_size,
+                row * self.tile_size,
+                (column + 1) * self.tile_size,
+                (row + 1) * self.tile_size
+            )
+            tile = self._get_map(tile_extent, tile_pixels, tile_pixels)
+            self.tile_cache.put(self.layer, self.tile_size, tile_pixels, column, row, tile)
+        return tile
+
+    def _image_size(self, extent: Tuple[float, float, float, float]) -> Tuple[int, int]:
+        """
+        Width and height in pixels for the extent, at the resolution of the layer.
+        """
+        extent_width = extent[2] - extent[0]
+        extent_height = extent[3] - extent[1]
+        if self.gsd is None:
+            # unknown resolution, fall back to the maximum size with the aspect ratio of the extent
+            pixels_per_meter = self.max_size / max(extent_width, extent_height, 1e-9)
+        else:
+            pixels_per_meter = self.oversampling / self.gsd
+        width = extent_width * pixels_per_meter
+        height = extent_height * pixels_per_meter
+
+        scale = min(1.0, self.max_size / max(width, height, 1e-9))
+        return max(1, ceil(width * scale)), max(1, ceil(height * scale))
+
+    def _gsd_from_layer(self, layer: str) -> Optional[float]:
+        """
+        Cyclomedia layer names end with their resolution, e.g. NL_aerial_2021_10cm
+        """
+        match = re.search(r'(\d+(?:\.\d+)?)cm', layer)
+        if match is None:
+            return None
+        return float(match.group(1)) / 100
+
+    def _get_map(self, extent: Tuple[float, float, float, float], width: int, height: int) -> bytes:
+        """
+        GetMap request for the extent (min x, min y, max x, max y), returns the image bytes.
+        """
+        parameter_srs = f"EPSG:{self.srs}"
+        parameter_format = "image/tiff"
+
+        params = {
+            "SERVICE": "WMS",
+            "VERSION": "1.1.1",
+            "REQUEST": "GetMap",
+            "LAYERS": self.layer,
+            "STYLES": "",
+            "SRS": parameter_srs,
+            "BBOX": ",".join(str(coordinate) for coordinate in extent),
+            "WIDTH": width,
+            "HEIGHT": height,
+            "FORMAT": parameter_format
+        }
+        if self.limiter is not None:
+            self.limiter.acquire()
+        resp = self.session.get(self.url, params=params, timeout=self.timeout)
+        raise_for_throttling(resp)
+        resp.raise_for_status()
+        # WMS reports errors as an xml service exception with a 200 status code
+        if 'xml' in resp.headers.get('Content-Type', ''):
+            raise requests.exceptions.HTTPError(f"WMS service exception: {resp.text}")
+        return resp.content
@@ -0,0 +1,284 @@
+import os
+from typing import Dict, List
+
+import numpy as np
+
+from src.model_generator.cityjson_seq_writer import CityJSONSeqWriter
+from src.model_generator.image_writer import ImageWriter
+from src.model_generator.model_generator import ModelGenerator
+from src.model_generator.vertex_pool import VertexPool
+from src.polygon_calculator.packed_geometry import PackedRings, RingBounds
+from src.polygon_calculator.uv_calculator import UVCalculator
+
+from models.dataclass_mappings.buildings import Building_dataclass
+from models.dataclass_mappings.surfaces import Surface_dataclass, Surface_type
+
+
+class CityJSONBase(ModelGenerator):
+    """
+    The parts of CityJSON generation that don't depend on a CityJSON library:
+    transform, normalization, vertex indexing, uv mapping and plain CityJSON city objects.
+    Shared by the cjio backend and the direct backend.
+
+    The textures are encoded and written by the image writer, png by default.
+    """
+
+    # bump when the generated output changes, this invalidates the result cache
+    version = 1
+
+    def __init__(self, image_writer: ImageWriter = None):
+        super().__init__()
+        self.image_writer = image_writer or ImageWriter()
+
+    def cache_parameters(self) -> str:
+        """
+        Everything of the generator that changes its output, part of the result cache key.
+        """
+        return (
+            f"{type(self).__name__}|{self.version}|"
+            f"{self.image_writer.image_format}|{self.image_writer.quality}"
+        )
+
+    def _create_uv_calculator(self, building: Building_dataclass) -> UVCalculator:
+        return UVCalculator(
+            building_id=building.id,
+            texture_type=self.image_writer.texture_type,
+            texture_extension=self.image_writer.extension
+        )
+
+    def generate_feature(
+        self,
+        building: Building_dataclass,
+        transform: Dict,
+        textures_enabled: bool = False,
+        packed: PackedRings = None
+    ) -> Dict:
+        """
+        Generates the building as a CityJSONFeature, for CityJSON text sequences.
+        The vertices are transformed with the supplied transform, shared by all features of the sequence,
+        and are indexed through the vertex pool of the feature.
+        """
+        uv_calculator = self._create_uv_calculator(building)
+        appearance = self._construct_base_appearance(textures_enabled=textures_enabled)
+
+        normalized_rings = self._normalize_geometries(
+            building=building,
+            translation_coordinates=transform,
+            packed=packed
+        )
+        vertex_pool = VertexPool()
+        surface_indices = self._extract_boundaries(
+            building=building,
+            normalized_rings=normalized_rings,
+            vertex_pool=vertex_pool
+        )
+        texture_indices_per_surface = uv_calculator.map_uv_appearances(
+            surfaces=list(surface_indices.values()),
+            appearance=appearance,
+            textures_enabled=textures_enabled,
+            packed=normalized_rings
+        )
+
+        feature = {
+            "type": "CityJSONFeature",
+            "id": building.id,
+            "CityObjects": self._construct_city_objects(
+                building=building,
+                surface_indices=surface_indices,
+                texture_indices_per_surface=texture_indices_per_surface,
+                textures_enabled=textures_enabled
+            ),
+            "vertices": vertex_pool.tolist()
+        }
+        if textures_enabled:
+            feature["appearance"] = appearance
+        return feature
+
+    def write_feature(
+        self,
+        building: Building_dataclass,
+        writer: CityJSONSeqWriter,
+        textures_enabled: bool = False,
+        packed: PackedRings = None
+    ) -> None:
+        """
+        Generates the building as a feature and streams it to the sequence writer.
+        The surfaces are packed here unless they were packed already.
+        """
+        packed = packed if packed is not None else PackedRings.from_surfaces(building.surfaces)
+        transform = writer.ensure_header(self._get_translation(building=building, bounds=packed.bounds())["transform"])
+        writer.write_feature(
+            self.generate_feature(building, transform=transform, textures_enabled=textures_enabled, packed=packed)
+        )
+
+    def _construct_city_objects(
+        self,
+        building: Building_dataclass,
+        surface_indices: Dict,
+        texture_indices_per_surface: List,
+        textures_enabled: bool = False
+    ) -> Dict:
+        """
+        Same structure as generate builds with cjio, but as plain CityJSON
+        with the boundaries referring to the vertex pool:
+        a Building with one BuildingPart (a single surface Solid) per surface.
+        """
+        city_objects = {
+            building.id: {
+                "type": "Building",
+                "children": []
+            }
+        }
+        for boundary, surface in surface_indices.items():
+            geometry = {
+                "type": "Solid",
+                "lod": "2.2",
+                "boundaries": [[surface["boundaries"]]],
+                "semantics": {
+                    "surfaces": [{"type": surface["type"]}],
+                    "values": [[0]]
+                }
+            }
+            if textures_enabled:
+                # the uv of the closing point isn't part of the open boundary ring
+                geometry["texture"] = {
+                    "cyclomedia": {
+                        "values": [[[texture_indices_per_surface[boundary][:-1]]]]
+                    }
+                }
+            city_objects[surface["id"]] = {
+                "type": "BuildingPart",
+                "parents": [building.id],
+                "geometry": [geometry]
+            }
+            city_objects[building.id]["children"].append(surface["id"])
+        return city_objects
+
+    def save_images(
+        self,
+        building: Building_dataclass,
+        images: List,
+        output_dir: str = ''
+    ) -> None:
+        """
+        Writes the textures of the building to {output_dir}/{building id}/{surface id}.{extension},
+        the paths the appearance of the building refers to.
+        """
+        self.image_writer.write(images, os.path.join(output_dir, building.id))
+
+    def _construct_template(
+        self,
+        building: Building_dataclass,
+        bounds: RingBounds = None
+    ) -> dict:
+
+        bounds = bounds if bounds is not None else PackedRings.from_surfaces(building.surfaces).bounds()
+        geographical_bbox = self._construct_geographical_extent(building, bounds=bounds)
+        return {
+            "type": "CityJSON",
+            "version": "1.1",
+            "metadata": {
+                    "referenceSystem": "https://www.opengis.net/def/crs/EPSG/0/28992",
+                    "geographicalExtent": geographical_bbox
+            },
+            "CityObjects": {},
+            "vertices": [],
+            "transform": self._get_translation(building=building, bounds=bounds)["transform"],
+            "appearance": {}
+        }
+
+    def _get_translation(self, building: Building_dataclass, bounds: RingBounds = None) -> Dict:
+        """
+        Get a minimum translation to scale down the coordinates
+        from the groundsurface.
+
+        Most buildings only have 1 groundsurface,
+        so take that as a rule of thumb (the last one when there are several,
+        the whole building when there is none).
+        return this as a dict for CityJSON generation.
+        """
+        bounds = bounds if bounds is not None else PackedRings.from_surfaces(building.surfaces).bounds()
+        ground_surfaces = [
+            index for index, surface in enumerate(building.surfaces)
+            if surface.semantics_value == Surface_type.GroundSurface
+        ]
+        x_min, y_min, _ = bounds.extent(ground_surfaces[-1:] or None)[:3]
+        return {
+            "transform": {
+                "scale": [0.01, 0.01, 0.01],
+                "translate": [x_min, y_min, 0.0]
+            }
+        }
+
+    def _construct_geographical_extent(self, building: Building_dataclass, bounds: RingBounds = None) -> list:
+        """
+        The extent of all surfaces of the building, from the bounds of the packed surfaces.
+        """
+        bounds = bounds if bounds is not None else PackedRings.from_surfaces(building.surfaces).bounds()
+        return bounds.extent()
+
+    def _extract_boundaries(
+        self,
+        building: Building_dataclass,
+        normalized_rings: PackedRings,
+        vertex_pool: VertexPool
+    ) -> Dict:
+        """
+        Extract the boundaries and put them in a layered dictionary, construct a 2d array from this dictionary
+
+        Every vertex is added to the shared vertex pool:
+        - surface holds the closed rings as coordinates, taken from the pool so shared corners are shared tuples
+        - boundaries holds the open rings as indices into the pool, as CityJSON expects them
+        """
+        vertex_indices = vertex_pool.add(normalized_rings.coordinates).tolist()
+        vertices = vertex_pool.vertices
+        surface_indices = {}
+        for index, surface in enumerate(building.surfaces):
+            ring = vertex_indices[normalized_rings.offsets[index]:normalized_rings.offsets[index + 1]]
+            surface_indices[index] = {
+                "id": surface.id,
+                "building_id": building.id,
+                "surface": [[vertices[vertex_index] for vertex_index in ring]],
+                "boundaries": [ring[:-1]],
+                "type": self._construct_types(surface.semantics_value)
+            }
+        return surface_indices
+
+    def _construct_types(self, surface_type: Surface_dataclass.semantics_value) -> str:
+        """
+        Per cityJSON/cityGML standard
+        """
+        if surface_type == Surface_type.GroundSurface:
+            return "GroundSurface"
+        elif surface_type == Surface_type.OuterWallSurface or surface_type == Surface_type.InnerWallSurface:
+            return "WallSurface"
+        else:
+            return 'RoofSurface'
+
+    def _normalize_geometries(
+        self,
+        building: Building_dataclass,
+        translation_coordinates: Dict,
+        packed: PackedRings = None
+    ) -> PackedRings:
+        """
+        extract the translation coordinates from the geometries
+        and normalizes the geometries using the transform component.
+
+        All coordinates of the building are translated, scaled and rounded to integers in one go,
+        the surfaces of the building itself are left untouched.
+        The surfaces are packed here unless they were packed already.
+        """
+        packed = packed if packed is not None else PackedRings.from_surfaces(building.surfaces)
+        translate = np.asarray(translation_coordinates["translate"], dtype=np.float64)
+        scale = np.asarray(translation_coordinates["scale"], dtype=np.float64)
+        normalized = np.rint((packed.coordinates - translate) / scale).astype(np.int64)
+        return PackedRings(coordinates=normalized, offsets=packed.offsets)
+
+    def _construct_base_appearance(self, textures_enabled: bool = False) -> Dict:
+        appearance = {}
+        if textures_enabled:
+            appearance["textures"] = []
+            appearance["vertices-texture"] = []
+
+        return appearance
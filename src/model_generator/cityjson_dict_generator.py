@@ -0,0 +1,134 @@
+import json
+import os
+from typing import Dict, List
+
+try:
+    # orjson serializes the vertex lists several times faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
+
+from src.model_generator.cityjson_base import CityJSONBase
+from src.model_generator.image_writer import ImageWriter, atomic_directory
+from src.model_generator.result_cache import ResultCache
+from src.model_generator.texture_atlas import TextureAtlasPacker
+from src.model_generator.vertex_pool import VertexPool
+from src.polygon_calculator.packed_geometry import PackedRings
+
+from models.dataclass_mappings.buildings import Building_dataclass
+
+
+class CityJSONDictGenerator(CityJSONBase):
+    """
+    Generates CityJSON as a plain dict straight from the packed geometry arrays,
+    without building cjio city objects and geometries.
+
+    Produces the same city objects as CityJSONGenerator, but the vertices are kept in
+    the order of the vertex pool instead of being rebuilt and deduplicated again by cjio on save.
+
+    With a texture_atlas packer the surface images are saved as a few atlas images
+    instead of one image per surface.
+    """
+
+    def __init__(self, texture_atlas: TextureAtlasPacker = None, image_writer: ImageWriter = None):
+        super().__init__(image_writer=image_writer)
+        self.texture_atlas = texture_atlas
+
+    def generate(
+        self,
+        building: Building_dataclass,
+        textures_enabled: bool = False,
+        packed: PackedRings = None
+    ) -> Dict:
+        uv_calculator = self._create_uv_calculator(building)
+        appearance = self._construct_base_appearance(textures_enabled=textures_enabled)
+        # one packed array for the extent, translation, normalization and uv's, unless it was packed already
+        packed = packed if packed is not None else PackedRings.from_surfaces(building.surfaces)
+        cityjson = self._construct_template(building=building, bounds=packed.bounds())
+
+        normalized_rings = self._normalize_geometries(
+            building=building,
+            translation_coordinates=cityjson["transform"],
+            packed=packed
+        )
+        vertex_pool = VertexPool()
+        surface_indices = self._extract_boundaries(
+            building=building,
+            normalized_rings=normalized_rings,
+            vertex_pool=vertex_pool
+        )
+        texture_indices_per_surface = uv_calculator.map_uv_appearances(
+            surfaces=list(surface_indices.values()),
+            appearance=appearance,
+            textures_enabled=textures_enabled,
+            packed=normalized_rings
+        )
+
+        cityjson["CityObjects"] = self._construct_city_objects(
+            building=building,
+            surface_indices=surface_indices,
+            texture_indices_per_surface=texture_indices_per_surface,
+            textures_enabled=textures_enabled
+        )
+        cityjson["vertices"] = vertex_pool.tolist()
+        cityjson["appearance"] = appearance
+        return cityjson
+
+    def cache_parameters(self) -> str:
+        atlas = self.texture_atlas
+        atlas_parameters = f"atlas={atlas.max_size},{atlas.padding}" if atlas is not None else "atlas=none"
+        return f"{super().cache_parameters()}|{atlas_parameters}"
+
+    def save(
+        self,
+        building: Building_dataclass,
+        images: List,
+        cm: Dict,
+        filename: str,
+        output_dir: str = '',
+        cache_key: str = None,
+        missing_surface_ids: List = ()
+    ) -> None:
+        # save the building and their images, the previous output is only replaced once everything is written
+        with atomic_directory(os.path.join(output_dir, building.id)) as dir:
+            if self.texture_atlas is not None and images:
+                self.save_atlas(images=images, cm=cm, dir=dir, texture_prefix=f"/{building.id}/")
+            else:
+                self.image_writer.write(images, dir)
+
+            with open(f"{dir}/{filename}.json", "wb") as file:
+                file.write(self.dumps(cm))
+            ResultCache.store(dir, cache_key, missing_surface_ids)
+
+    def save_atlas(
+        self,
+        images: List,
+        cm: Dict,
+        dir: str,
+        texture_prefix: str
+    ) -> None:
+        """
+        Packs the images into atlases written to {dir}/atlas_{n}.{extension}
+        and points the textures of the model to them, at {texture_prefix}atlas_{n}.{extension}.
+        """
+        atlas = self.texture_atlas.build(images, pool=self.image_writer.pool)
+        extension = self.image_writer.extension
+        # the atlases are encoded on the pool of the image writer, like the per surface textures
+        self.image_writer.write_images(
+            {f"atlas_{index}": atlas_image for index, atlas_image in enumerate(atlas.images)}, dir
+        )
+        self.texture_atlas.remap_appearance(
+            cityjson=cm,
+            atlas=atlas,
+            texture_paths=[f"{texture_prefix}atlas_{index}.{extension}" for index in range(len(atlas.images))],
+            texture_type=self.image_writer.texture_type
+        )
+
+    @staticmethod
+    def dumps(cityjson: Dict) -> bytes:
+        """
+        Serializes the CityJSON dict to compact utf-8 json.
+        """
+        if orjson is not None:
+            return orjson.dumps(cityjson, option=orjson.OPT_SERIALIZE_NUMPY)
+        return json.dumps(cityjson, separators=(',', ':')).encode('utf-8')
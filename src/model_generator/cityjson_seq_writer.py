@@ -0,0 +1,71 @@
+import json
+from threading import Lock
+from typing import Dict, TextIO
+
+
+class CityJSONSeqWriter:
+    """
+    Streams buildings to a CityJSON text sequence (CityJSONSeq, .city.jsonl):
+    the first line is a CityJSON object holding the transform and metadata,
+    every following line is one CityJSONFeature.
+
+    Features are written as soon as they are generated, so memory use doesn't grow with
+    the amount of buildings. All features share the transform of the header,
+    when none is supplied the transform of the first building is used.
+    Safe to use from several threads.
+    """
+
+    def __init__(
+        self,
+        file: TextIO,
+        transform: Dict = None,
+        reference_system: str = "https://www.opengis.net/def/crs/EPSG/0/28992"
+    ) -> None:
+        self.file = file
+        self.transform = transform
+        self.reference_system = reference_system
+        self.features_written = 0
+        self._header_written = False
+        self._lock = Lock()
+
+    def __enter__(self) -> 'CityJSONSeqWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def ensure_header(self, transform: Dict) -> Dict:
+        """
+        Writes the header with the supplied transform unless a header was written already,
+        returns the transform all features have to use.
+        """
+        with self._lock:
+            if not self._header_written:
+                self.transform = self.transform or transform
+                self._write_line({
+                    "type": "CityJSON",
+                    "version": "1.1",
+                    "transform": self.transform,
+                    "metadata": {
+                        "referenceSystem": self.reference_system
+                    },
+                    "CityObjects": {},
+                    "vertices": []
+                })
+                self._header_written = True
+            return self.transform
+
+    def write_feature(self, feature: Dict) -> None:
+        with self._lock:
+            if not self._header_written:
+                raise RuntimeError("write the header with ensure_header before writing features")
+            self._write_line(feature)
+            self.features_written += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self.file.flush()
+
+    def _write_line(self, document: Dict) -> None:
+        self.file.write(json.dumps(document, separators=(',', ':')))
+        self.file.write('\n')
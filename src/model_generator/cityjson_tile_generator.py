@@ -0,0 +1,135 @@
+import os
+import tempfile
+from collections import defaultdict
+from typing import Dict, List
+
+from src.model_generator.cityjson_dict_generator import CityJSONDictGenerator
+from src.model_generator.image_writer import atomic_directory
+from src.model_generator.vertex_pool import VertexPool
+from src.polygon_calculator.packed_geometry import PackedRings
+
+from models.dataclass_mappings.buildings import Building_dataclass
+
+
+class CityJSONTileGenerator(CityJSONDictGenerator):
+    """
+    Generates the buildings of an area as one CityJSON tile,
+    with a single transform, vertex list and appearance shared by all buildings.
+
+    The surfaces of all buildings are packed, normalized and uv mapped in one go.
+    Textures are written to {output_dir}/{bag building id}/ like the per building output,
+    or into the atlases of the tile at {output_dir}/{filename}_textures/ with a texture atlas.
+    """
+
+    def generate_tile(
+        self,
+        buildings: List[Building_dataclass],
+        textures_enabled: bool = False
+    ) -> Dict:
+        surfaces = [surface for building in buildings for surface in building.surfaces]
+        if not surfaces:
+            raise ValueError("a tile needs at least one building with surfaces")
+
+        packed = PackedRings.from_surfaces(surfaces)
+        extent = packed.bounds().extent()
+        transform = {
+            "scale": [0.01, 0.01, 0.01],
+            "translate": [extent[0], extent[1], 0.0]
+        }
+        normalized_rings = self._normalize_geometries(
+            building=None,
+            translation_coordinates=transform,
+            packed=packed
+        )
+
+        # boundaries per building, indexing into the vertex pool of the tile
+        vertex_pool = VertexPool()
+        surface_indices_per_building = []
+        first_surface = 0
+        for building in buildings:
+            last_surface = first_surface + len(building.surfaces)
+            offsets = normalized_rings.offsets[first_surface:last_surface + 1]
+            building_rings = PackedRings(
+                coordinates=normalized_rings.coordinates[offsets[0]:offsets[-1]],
+                offsets=offsets - offsets[0]
+            )
+            surface_indices_per_building.append(
+                self._extract_boundaries(building=building, normalized_rings=building_rings, vertex_pool=vertex_pool)
+            )
+            first_surface = last_surface
+
+        appearance = self._construct_base_appearance(textures_enabled=textures_enabled)
+        uv_calculator = self._create_uv_calculator(Building_dataclass(id='tile'))
+        texture_indices = uv_calculator.map_uv_appearances(
+            surfaces=[
+                surface
+                for surface_indices in surface_indices_per_building
+                for surface in surface_indices.values()
+            ],
+            appearance=appearance,
+            textures_enabled=textures_enabled,
+            packed=normalized_rings
+        )
+
+        city_objects = {}
+        first_surface = 0
+        for building, surface_indices in zip(buildings, surface_indices_per_building):
+            last_surface = first_surface + len(surface_indices)
+            city_objects.update(
+                self._construct_city_objects(
+                    building=building,
+                    surface_indices=surface_indices,
+                    texture_indices_per_surface=texture_indices[first_surface:last_surface],
+                    textures_enabled=textures_enabled
+                )
+            )
+            first_surface = last_surface
+
+        return {
+            "type": "CityJSON",
+            "version": "1.1",
+            "metadata": {
+                "referenceSystem": "https://www.opengis.net/def/crs/EPSG/0/28992",
+                "geographicalExtent": extent
+            },
+            "CityObjects": city_objects,
+            "vertices": vertex_pool.tolist(),
+            "transform": transform,
+            "appearance": appearance
+        }
+
+    def save_tile(
+        self,
+        buildings: List[Building_dataclass],
+        images: List,
+        tile: Dict,
+        filename: str,
+        output_dir: str = ''
+    ) -> None:
+        """
+        Writes the tile to {output_dir}/{filename}.json, the file is replaced once it is complete.
+        """
+        os.makedirs(output_dir or '.', exist_ok=True)
+
+        if self.texture_atlas is not None and images:
+            with atomic_directory(os.path.join(output_dir, f"{filename}_textures")) as dir:
+                self.save_atlas(images=images, cm=tile, dir=dir, texture_prefix=f"/{filename}_textures/")
+        else:
+            building_ids = {
+                str(surface.id): building.id for building in buildings for surface in building.surfaces
+            }
+            images_per_building = defaultdict(list)
+            for image in images:
+                images_per_building[building_ids[str(image.surface_id)]].append(image)
+            for building_id, building_images in images_per_building.items():
+                self.image_writer.write(building_images, os.path.join(output_dir, building_id))
+
+        file_descriptor, temporary = tempfile.mkstemp(dir=output_dir or '.', prefix=f".{filename}.", suffix='.json')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                file.write(self.dumps(tile))
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, os.path.join(output_dir, f"{filename}.json"))
+        except BaseException:
+            os.remove(temporary)
+            raise
@@ -0,0 +1,189 @@
+import ctypes
+import errno
+import io
+import os
+import shutil
+import stat
+import sys
+from contextlib import contextmanager
+from os import getenv
+from typing import Dict, Iterator, List, Union
+from uuid import uuid4
+
+from PIL import Image
+
+from src.polygon_calculator.raster_image import RasterImage
+from src.worker_pool import WorkerPool
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# renameat2 arguments, to swap a directory atomically
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+_libc = ctypes.CDLL(None, use_errno=True) if sys.platform.startswith('linux') else None
+
+
+class ImageWriter:
+    """
+    Encodes and writes the textures of a building on a thread pool,
+    PIL releases the GIL while compressing so the images are encoded concurrently.
+
+    Blobs that are already in the output format are written as they are, without decoding,
+    cropped images that are still arrays are encoded straight from the array.
+    Supported formats are png and jpeg, the texture types CityJSON allows, quality applies to jpeg.
+    """
+
+    FORMATS = {
+        # format: (PIL format, file extension, CityJSON texture type)
+        'png': ('PNG', 'png', 'PNG'),
+        'jpeg': ('JPEG', 'jpg', 'JPG'),
+    }
+
+    def __init__(self, image_format: str = None, quality: int = None, workers: int = None) -> None:
+        image_format = (image_format or getenv('texture_format', 'png')).lower()
+        if image_format not in self.FORMATS:
+            raise ValueError(f"unsupported texture format {image_format}, CityJSON textures are {' or '.join(self.FORMATS)}")
+        self.image_format = image_format
+        self.quality = quality if quality is not None else int(getenv('texture_quality', 85))
+        self.workers = workers or int(getenv('texture_workers', os.cpu_count() or 4))
+
+        self._pool = WorkerPool(self.workers, thread_name_prefix='texture')
+
+    @property
+    def extension(self) -> str:
+        return self.FORMATS[self.image_format][1]
+
+    @property
+    def texture_type(self) -> str:
+        return self.FORMATS[self.image_format][2]
+
+    @property
+    def pool(self) -> WorkerPool:
+        return self._pool
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def write(self, images: List, directory: str) -> None:
+        """
+        Writes the image dataclasses to {directory}/{surface id}.{extension}.
+        """
+        os.makedirs(directory, exist_ok=True)
+        futures = [
+            self._pool.submit(self._write_file, f"{directory}/{image.surface_id}.{self.extension}", image.image)
+            for image in images
+        ]
+        for future in futures:
+            future.result()
+
+    def write_images(self, images: Dict[str, Image.Image], directory: str) -> None:
+        """
+        Encodes decoded images, e.g. texture atlases, to {directory}/{name}.{extension} on the pool.
+        """
+        os.makedirs(directory, exist_ok=True)
+        futures = [
+            self._pool.submit(self._write_image, f"{directory}/{name}.{self.extension}", image)
+            for name, image in images.items()
+        ]
+        for future in futures:
+            future.result()
+
+    def encode(self, blob: Union[bytes, RasterImage]) -> bytes:
+        """
+        Encodes an image blob in the output format, blobs already in that format pass through.
+        """
+        if isinstance(blob, RasterImage):
+            # reuses the png when it was encoded for the database already
+            return blob.encode() if self.image_format == 'png' else self.encode_image(blob.to_pil())
+        if self._is_output_format(blob):
+            return blob
+        with Image.open(io.BytesIO(blob)) as image:
+            return self.encode_image(image)
+
+    def encode_image(self, image: Image.Image) -> bytes:
+        pil_format = self.FORMATS[self.image_format][0]
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        if pil_format == 'PNG':
+            image.save(buffer, format=pil_format)
+        else:
+            image.save(buffer, format=pil_format, quality=self.quality)
+        return buffer.getvalue()
+
+    def _write_file(self, path: str, blob: Union[bytes, RasterImage]) -> None:
+        with open(path, 'wb') as file:
+            file.write(self.encode(blob))
+
+    def _write_image(self, path: str, image: Image.Image) -> None:
+        with open(path, 'wb') as file:
+            file.write(self.encode_image(image))
+
+    def _is_output_format(self, blob: bytes) -> bool:
+        if self.image_format == 'png':
+            return blob[:8] == PNG_SIGNATURE
+        return blob[:3] == b'\xff\xd8\xff'
+
+
+@contextmanager
+def atomic_directory(directory: str) -> Iterator[str]:
+    """
+    Yields a temporary directory next to the target directory, which replaces the target
+    once the block finishes. When the block fails the target is left as it was.
+
+    On Linux an existing target is exchanged with the temporary directory in one renameat2 call,
+    so readers see either the old or the new directory. Where that isn't supported the target is
+    moved aside first, then it is briefly missing.
+    The new directory keeps the mode of the directory it replaces, a new one gets the umask default.
+    """
+    parent, name = os.path.split(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temporary = _make_directory(parent, f".{name}.")
+    try:
+        yield temporary
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+
+    try:
+        mode = stat.S_IMODE(os.stat(directory).st_mode)
+    except FileNotFoundError:
+        os.rename(temporary, directory)
+        return
+    os.chmod(temporary, mode)
+    if _exchange(temporary, directory):
+        # the temporary path now holds the previous directory
+        shutil.rmtree(temporary, ignore_errors=True)
+        return
+    previous = _make_directory(parent, f".{name}.old.")
+    os.rename(directory, os.path.join(previous, name))
+    os.rename(temporary, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def _make_directory(parent: str, prefix: str) -> str:
+    """
+    Like tempfile.mkdtemp, but created with the umask default mode instead of 0700.
+    """
+    while True:
+        path = os.path.join(parent, f"{prefix}{uuid4().hex[:8]}")
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            continue
+
+
+def _exchange(first: str, second: str) -> bool:
+    """
+    Atomically swaps two paths with renameat2(RENAME_EXCHANGE), False when it isn't supported.
+    """
+    renameat2 = getattr(_libc, 'renameat2', None) if _libc is not None else None
+    if renameat2 is None:
+        return False
+    if renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+        return False
+    raise OSError(error, os.strerror(error), second)
@@ -15,3 +15,21 @@ class ModelGenerator(ABC):
 
     def generate(self):
         raise NotImplementedError("Implement this")
+
+
+def create_model_generator(name: str = 'direct', texture_atlas: bool = False) -> ModelGenerator:
+    """
+    direct (default): emits the CityJSON dict directly with the pooled, indexed vertices, cjio is never imported.
+    cjio: builds the model with (the forked) cjio, which writes the vertices of every ring itself.
+    texture_atlas packs the textures of a building into atlases, only supported by direct.
+    """
+    if name == 'cjio':
+        if texture_atlas:
+            raise ValueError("texture atlases are only supported by the direct model generator")
+        from src.model_generator.cityjson_generator import CityJSONGenerator
+        return CityJSONGenerator()
+    if name == 'direct':
+        from src.model_generator.cityjson_dict_generator import CityJSONDictGenerator
+        from src.model_generator.texture_atlas import TextureAtlasPacker
+        return CityJSONDictGenerator(texture_atlas=TextureAtlasPacker() if texture_atlas else None)
+    raise ValueError(f"unknown model generator {name}, choose cjio or direct")
@@ -0,0 +1,90 @@
+import hashlib
+import os
+from datetime import timedelta
+from os import getenv
+from time import time
+from typing import Iterable, List, Set
+
+from models.dataclass_mappings.buildings import Building_dataclass
+
+
+class ResultCache:
+    """
+    Skips generating buildings whose output is still current.
+
+    The key is a hash of the surface geometries of the building, the ids of its images
+    and the generator with its settings. It is written next to the generated CityJSON,
+    inside the directory that atomically replaces the previous output, so a stored key
+    always belongs to a complete output. A changed surface, image or generator gives
+    another key, which makes the stored output stale and has it regenerated.
+
+    The surfaces that got no image, because the service refused them or returned nothing to crop,
+    are stored with the key. Those have no stored image, so without this record every run would
+    request them again before it can tell the output is current. They are requested again once
+    the record is older than missing_max_age (cityjson_cache_missing_max_age_days, default 7).
+    """
+
+    KEY_FILE = '.cityjson_cache_key'
+    MISSING_FILE = '.cityjson_missing_images'
+
+    def __init__(self, enabled: bool = None, missing_max_age: timedelta = None) -> None:
+        self.enabled = enabled if enabled is not None else getenv('cityjson_cache_enabled', 'true').lower() == 'true'
+        self.missing_max_age = missing_max_age if missing_max_age is not None else timedelta(
+            days=float(getenv('cityjson_cache_missing_max_age_days', 7))
+        )
+
+    def key(self, building: Building_dataclass, images: List, generator_parameters: str, textures_enabled: bool) -> str:
+        digest = hashlib.sha256()
+        digest.update(f"{generator_parameters}|textures={textures_enabled}|".encode())
+        for surface in sorted(building.surfaces, key=lambda surface: str(surface.id)):
+            digest.update(f"{surface.id}|{surface.semantics_value}|".encode())
+            digest.update(surface.surface_geometry.wkb)
+        for image_id in sorted(str(image.id) for image in images):
+            digest.update(image_id.encode())
+        return digest.hexdigest()
+
+    def is_current(self, directory: str, filename: str, key: str) -> bool:
+        """
+        True when the output in the directory was generated for this key.
+        """
+        if not self.enabled or not os.path.exists(f"{directory}/{filename}.json"):
+            return False
+        try:
+            with open(os.path.join(directory, self.KEY_FILE)) as file:
+                return file.read().strip() == key
+        except FileNotFoundError:
+            return False
+
+    def missing_surface_ids(self, directory: str) -> Set[str]:
+        """
+        The ids of the surfaces without an image in the output in the directory, empty once the record expired.
+        """
+        path = os.path.join(directory, self.MISSING_FILE)
+        try:
+            if time() - os.path.getmtime(path) > self.missing_max_age.total_seconds():
+                return set()
+            with open(path) as file:
+                return set(file.read().split())
+        except FileNotFoundError:
+            return set()
+
+    @classmethod
+    def store(cls, directory: str, key: str = None, missing_surface_ids: Iterable = ()) -> None:
+        """
+        Called by the generators while saving, without a key nothing is stored.
+        """
+        if key is None:
+            return
+        with open(os.path.join(directory, cls.KEY_FILE), 'w') as file:
+            file.write(key)
+        cls.store_missing(directory, missing_surface_ids)
+
+    @classmethod
+    def store_missing(cls, directory: str, missing_surface_ids: Iterable) -> None:
+        """
+        Records the surfaces without an image, which restarts the expiry of the record.
+        """
+        missing_surface_ids = sorted(str(surface_id) for surface_id in missing_surface_ids)
+        if missing_surface_ids:
+            with open(os.path.join(directory, cls.MISSING_FILE), 'w') as file:
+                file.write('\n'.join(missing_surface_ids))
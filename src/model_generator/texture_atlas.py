@@ -0,0 +1,165 @@
+import io
+import math
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from src.polygon_calculator.raster_image import RasterImage
+from src.polygon_calculator.texture_vertex_buffer import TextureVertexBuffer
+from src.worker_pool import WorkerPool
+
+
+@dataclass
+class AtlasPlacement:
+    """
+    Where the image of a surface ended up: the atlas and the pixel rectangle within it.
+    """
+    atlas: int
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+@dataclass
+class TextureAtlas:
+    """
+    The packed atlas images with the placement of every surface image, keyed on surface id.
+    """
+    images: List[Image.Image] = field(default_factory=list)
+    placements: Dict[str, AtlasPlacement] = field(default_factory=dict)
+
+
+class TextureAtlasPacker:
+    """
+    Packs the surface images of a building (or a tile of buildings) into one or a few atlas images
+    with shelf bin-packing: the images are sorted on height and placed left to right on shelves,
+    a new atlas is started when a shelf doesn't fit the maximum atlas size anymore.
+
+    Viewers then load a handful of textures instead of one per surface.
+    """
+
+    def __init__(self, max_size: int = 4096, padding: int = 2) -> None:
+        self.max_size = max_size
+        # empty pixels between images, so texture filtering doesn't bleed into the neighbour
+        self.padding = padding
+
+    def pack(self, sizes: Dict[str, Tuple[int, int]]) -> Tuple[Dict[str, AtlasPlacement], List[Tuple[int, int]]]:
+        """
+        Places rectangles of (width, height), returns the placements and the size of every atlas.
+        Rectangles have to fit within max_size, see build for downscaling images that don't.
+        """
+        placements = {}
+        atlas_sizes = []
+        if not sizes:
+            return placements, atlas_sizes
+
+        # a roughly square atlas, as wide as the widest image at least
+        total_area = sum((width + self.padding) * (height + self.padding) for width, height in sizes.values())
+        widest = max(width for width, _ in sizes.values()) + self.padding
+        atlas_width = min(self.max_size, max(widest, math.ceil(math.sqrt(total_area))))
+
+        atlas, x, y, shelf_height, used_width = 0, 0, 0, 0, 0
+        for key, (width, height) in sorted(sizes.items(), key=lambda item: (-item[1][1], -item[1][0], item[0])):
+            if x + width > atlas_width:
+                # next shelf
+                x, y = 0, y + shelf_height
+                shelf_height = 0
+            if y + height > self.max_size:
+                # next atlas
+                atlas_sizes.append((used_width, y - self.padding))
+                atlas, x, y, shelf_height, used_width = atlas + 1, 0, 0, 0, 0
+            placements[key] = AtlasPlacement(atlas=atlas, x=x, y=y, width=width, height=height)
+            used_width = max(used_width, x + width)
+            x += width + self.padding
+            shelf_height = max(shelf_height, height + self.padding)
+        atlas_sizes.append((used_width, y + shelf_height - self.padding))
+        return placements, atlas_sizes
+
+    def build(self, images: List, pool: WorkerPool = None) -> TextureAtlas:
+        """
+        Decodes the image blobs of the supplied image dataclasses and pastes them into atlas images.
+        Images larger than the atlas are scaled down to fit.
+        With a pool the images are decoded on its threads, PIL releases the GIL while decoding.
+        """
+        decoded_images = pool.map(self._decode, images) if pool is not None else map(self._decode, images)
+        decoded = {str(image.surface_id): decoded_image for image, decoded_image in zip(images, decoded_images)}
+
+        placements, atlas_sizes = self.pack({key: image.size for key, image in decoded.items()})
+        atlas = TextureAtlas(
+            images=[Image.new('RGB', size) for size in atlas_sizes],
+            placements=placements
+        )
+        for key, placement in placements.items():
+            atlas.images[placement.atlas].paste(decoded[key], (placement.x, placement.y))
+        return atlas
+
+    def _decode(self, image) -> Image.Image:
+        if isinstance(image.image, RasterImage):
+            decoded_image = image.image.to_pil().convert('RGB')
+        else:
+            decoded_image = Image.open(io.BytesIO(image.image)).convert('RGB')
+        if max(decoded_image.size) > self.max_size:
+            decoded_image.thumbnail((self.max_size, self.max_size))
+        return decoded_image
+
+    def remap_appearance(
+        self,
+        cityjson: Dict,
+        atlas: TextureAtlas,
+        texture_paths: List[str],
+        texture_type: str = 'PNG'
+    ) -> Dict:
+        """
+        Points the textured surfaces of a CityJSON dict (or CityJSONFeature) to the atlas images
+        and remaps their uv's into the rectangle of the surface within the atlas.
+        Surfaces without an image in the atlas keep their own texture.
+
+        The object ids of the surfaces are the surface ids of the images.
+        """
+        appearance = cityjson.get("appearance", {})
+        if "textures" not in appearance:
+            return cityjson
+
+        old_textures = appearance["textures"]
+        old_uvs = np.asarray(appearance["vertices-texture"], dtype=np.float64).reshape(-1, 2)
+        atlas_sizes = np.array([image.size for image in atlas.images], dtype=np.float64).reshape(-1, 2)
+
+        textures = [{"type": texture_type, "image": path} for path in texture_paths]
+        kept_textures = {}
+        texture_vertices = TextureVertexBuffer()
+
+        def remap_ring(ring: List, placement: AtlasPlacement) -> List:
+            texture_index, uvs = ring[0], old_uvs[ring[1:]]
+            if placement is None:
+                if texture_index not in kept_textures:
+                    kept_textures[texture_index] = len(textures)
+                    textures.append(old_textures[texture_index])
+                texture_index = kept_textures[texture_index]
+            else:
+                atlas_width, atlas_height = atlas_sizes[placement.atlas]
+                # uv's start at the bottom left, pixels at the top left
+                uvs = np.column_stack([
+                    (placement.x + uvs[:, 0] * placement.width) / atlas_width,
+                    1 - (placement.y + (1 - uvs[:, 1]) * placement.height) / atlas_height
+                ])
+                texture_index = placement.atlas
+            return [texture_index] + texture_vertices.add(np.round(uvs, 6)).tolist()
+
+        def remap_values(values: List, placement: AtlasPlacement) -> List:
+            if values and isinstance(values[0], list):
+                return [remap_values(value, placement) for value in values]
+            if not values or values[0] is None:
+                return values
+            return remap_ring(values, placement)
+
+        for object_id, city_object in cityjson["CityObjects"].items():
+            for geometry in city_object.get("geometry", []):
+                for theme in geometry.get("texture", {}).values():
+                    theme["values"] = remap_values(theme["values"], atlas.placements.get(object_id))
+
+        appearance["textures"] = textures
+        appearance["vertices-texture"] = texture_vertices.tolist()
+        return cityjson
@@ -0,0 +1,41 @@
+from typing import List, Tuple
+
+import numpy as np
+
+
+class VertexPool:
+    """
+    Shared, deduplicated list of the (integer, transformed) vertices of a CityJSON model.
+    Surfaces meeting in the same corner get the same index, boundaries refer to vertices by index.
+    """
+
+    def __init__(self) -> None:
+        self._lookup = {}
+        self._vertices: List[Tuple[int, int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._vertices)
+
+    @property
+    def vertices(self) -> List[Tuple[int, int, int]]:
+        return self._vertices
+
+    def add(self, coordinates: np.ndarray) -> np.ndarray:
+        """
+        Adds an (n, 3) array of integer coordinates, returns the index of every coordinate in the pool.
+        """
+        if len(coordinates) == 0:
+            return np.empty(0, dtype=np.int64)
+        unique_coordinates, inverse = np.unique(coordinates, axis=0, return_inverse=True)
+        unique_indices = np.empty(len(unique_coordinates), dtype=np.int64)
+        for position, vertex in enumerate(map(tuple, unique_coordinates.tolist())):
+            index = self._lookup.get(vertex)
+            if index is None:
+                index = len(self._vertices)
+                self._lookup[vertex] = index
+                self._vertices.append(vertex)
+            unique_indices[position] = index
+        return unique_indices[inverse.reshape(-1)]
+
+    def tolist(self) -> List[List[int]]:
+        return [list(vertex) for vertex in self._vertices]
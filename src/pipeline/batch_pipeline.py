@@ -0,0 +1,262 @@
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Dict, Iterable, List
+
+from psycopg2.errors import NoDataFound
+
+from src.bag_extractor.cache_policy import ImageCachePolicy
+from src.bag_extractor.db_handler import BagCollector
+from src.image_extractor.image_collector import ImageCollector
+from src.polygon_calculator.packed_geometry import PackedRings
+from src.polygon_calculator.surface_calculator import SurfaceCalculator
+from src.model_generator.cityjson_base import CityJSONBase
+from src.model_generator.cityjson_seq_writer import CityJSONSeqWriter
+from src.model_generator.model_generator import create_model_generator
+from src.model_generator.result_cache import ResultCache
+from models.dataclass_mappings.buildings import Building_dataclass
+
+
+@dataclass
+class BatchResult:
+    """
+    Outcome of a batch run, failed holds the bag building id with the reason.
+    """
+    succeeded: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+
+
+class BatchPipeline:
+    """
+    Runs the collect -> bounding box -> image -> cityjson chain for many buildings.
+
+    The database engine, the http session and the image worker pool are created once
+    and shared by all buildings. Buildings are processed by a bounded number of threads,
+    so while one building waits on the image api another one is queried or written to disk.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        image_workers: int = 10,
+        output_dir: str = '',
+        filename: str = 'prototype_portfolio',
+        textures_enabled: bool = True,
+        cache_policy: ImageCachePolicy = None,
+        seq_writer: CityJSONSeqWriter = None,
+        model_generator: CityJSONBase = None,
+        result_cache: ResultCache = None,
+        fetch_batch_size: int = 100
+    ) -> None:
+        """
+        With a seq_writer all buildings are streamed as features into one CityJSON text sequence,
+        otherwise every building is saved as its own CityJSON file.
+        The textures are written to {output_dir}/{bag building id}/ in both cases.
+        Without a model_generator the direct generator is used.
+        Buildings whose surfaces, images and generator didn't change since their output
+        was written are not generated again, unless the result cache is disabled.
+        The buildings are queried fetch_batch_size ids at a time, in one round trip per batch.
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.workers = workers
+        self.output_dir = output_dir
+        self.filename = filename
+        self.textures_enabled = textures_enabled
+        self.cache_policy = cache_policy or ImageCachePolicy.from_env()
+        self.seq_writer = seq_writer
+        self.result_cache = result_cache or ResultCache()
+        self.fetch_batch_size = fetch_batch_size
+
+        # never hold more than a couple of buildings per worker in memory.
+        self.max_in_flight = workers * 2
+
+        self.bag_collector = BagCollector()
+        self.surface_calculator = SurfaceCalculator()
+        self.image_collector = ImageCollector(workers=image_workers)
+        self.model_generator = model_generator or create_model_generator()
+
+    def run(self, bag_building_ids: Iterable[str]) -> BatchResult:
+        """
+        Processes all supplied bag building ids, the iterable is consumed lazily
+        so it can be a file, stdin or a database cursor.
+        """
+        result = BatchResult()
+        in_flight: Dict[Future, str] = {}
+
+        bag_building_ids = iter(bag_building_ids)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='building') as executor:
+                while batch := list(islice(bag_building_ids, self.fetch_batch_size)):
+                    for building in self._fetch_batch(batch, result):
+                        if len(in_flight) >= self.max_in_flight:
+                            self._drain(in_flight, result, return_when=FIRST_COMPLETED)
+                        in_flight[executor.submit(self.process_building, building.id, building)] = building.id
+                self._drain(in_flight, result)
+        finally:
+            self.image_collector.close()
+            self.surface_calculator.close()
+            self.model_generator.image_writer.close()
+
+        self.logger.info(
+            f"batch done: {len(result.succeeded)} succeeded, "
+            f"{len(result.skipped)} skipped, {len(result.failed)} failed"
+        )
+        return result
+
+    def process_building(self, bag_building_id: str, building: Building_dataclass = None) -> None:
+        """
+        Runs the full chain for a single building, which is queried first unless it is supplied.
+        One database session serves the reads and the stores of the building.
+        """
+        with self.bag_collector.session_factory.build() as session:
+            if building is None:
+                building = self.bag_collector.fetch_building(bag_building_id, session=session)
+            # packed once for the bounding boxes and the model
+            packed = PackedRings.from_surfaces(building.surfaces)
+            outer_wall_bboxes, roof_bboxes = self.surface_calculator.calculate_surface_bounding_boxes(
+                building, packed=packed
+            )
+
+            # only surfaces without a (fresh) stored image go to the image api's
+            cached_streetview_images, outer_wall_bboxes, cached_aerial_images, roof_bboxes = \
+                self.bag_collector.collect_cached_images(
+                    outer_wall_bboxes, roof_bboxes, self.cache_policy, session=session
+                )
+
+            # when every surface has a stored image, or got none the last time, an output generated
+            # from the stored images is returned before any image api is called.
+            if self.seq_writer is None and self.result_cache.enabled:
+                missing_surface_ids = self.result_cache.missing_surface_ids(os.path.join(self.output_dir, building.id))
+                if all(str(bbox.surface_id) in missing_surface_ids for bbox in outer_wall_bboxes + roof_bboxes):
+                    cache_key = self._cache_key(building, cached_streetview_images + cached_aerial_images)
+                    if self._is_current(building, cache_key):
+                        return
+
+            # hands the connection back to the pool while the image api's are called, the stores check one out again.
+            session.close()
+
+            panoramas, streetview_images, aerial_images, failures = self.image_collector.collect_images(
+                outer_wall_bboxes,
+                roof_bboxes
+            )
+            for failure in failures:
+                self.logger.warning(
+                    f"{bag_building_id}: no {failure.service} image for surface {failure.surface_id}: {failure.error}"
+                )
+            cropped_roof_images = self.surface_calculator.process_roof_images(building=building, images=aerial_images)
+
+            self.bag_collector.store_streetview(
+                panoramas, streetview_images, refresh=self.cache_policy.refreshes, session=session
+            )
+            self.bag_collector.store_aerial(
+                cropped_roof_images=cropped_roof_images, refresh=self.cache_policy.refreshes, session=session
+            )
+
+            streetview_images = cached_streetview_images + streetview_images
+            cropped_roof_images = cached_aerial_images + cropped_roof_images
+
+            if self.seq_writer is not None:
+                self.model_generator.write_feature(
+                    building=building,
+                    writer=self.seq_writer,
+                    textures_enabled=self.textures_enabled,
+                    packed=packed
+                )
+                self.model_generator.save_images(
+                    building=building,
+                    images=streetview_images + cropped_roof_images,
+                    output_dir=self.output_dir
+                )
+                return
+
+            images = streetview_images + cropped_roof_images
+            missing_surface_ids = self._missing_surface_ids(outer_wall_bboxes + roof_bboxes, images, failures)
+            cache_key = None
+            if self.result_cache.enabled:
+                cache_key = self._cache_key(building, images)
+                if self._is_current(building, cache_key):
+                    # the expired surfaces still got no image, they are skipped again until the record expires
+                    self.result_cache.store_missing(os.path.join(self.output_dir, building.id), missing_surface_ids)
+                    return
+
+            cm = self.model_generator.generate(
+                building=building,
+                textures_enabled=self.textures_enabled,
+                packed=packed
+            )
+            self.model_generator.save(
+                building=building,
+                images=images,
+                cm=cm,
+                filename=self.filename,
+                output_dir=self.output_dir,
+                cache_key=cache_key,
+                missing_surface_ids=missing_surface_ids
+            )
+
+    def _fetch_batch(self, bag_building_ids: List[str], result: BatchResult) -> List[Building_dataclass]:
+        """
+        Queries the buildings of a batch of ids with their surfaces in one round trip, in the order of the ids.
+        Unknown ids and buildings without surfaces are skipped, a failed query fails the whole batch.
+        """
+        try:
+            buildings = {building.id: building for building in self.bag_collector.collect_buildings(bag_building_ids)}
+        except Exception as e:
+            self.logger.error(f"batch of {len(bag_building_ids)} buildings: {e}")
+            result.failed.update((bag_building_id, str(e)) for bag_building_id in bag_building_ids)
+            return []
+
+        found = []
+        for bag_building_id in bag_building_ids:
+            building = buildings.get(bag_building_id)
+            if building is None or not building.surfaces:
+                reason = "Bag building id not found!" if building is None else "building has no surfaces"
+                self.logger.warning(f"{bag_building_id}: {reason}")
+                result.skipped.append(bag_building_id)
+                continue
+            found.append(building)
+        return found
+
+    def _cache_key(self, building: Building_dataclass, images: List) -> str:
+        return self.result_cache.key(
+            building=building,
+            images=images,
+            generator_parameters=self.model_generator.cache_parameters(),
+            textures_enabled=self.textures_enabled
+        )
+
+    def _missing_surface_ids(self, bboxes: List, images: List, failures: List) -> List[str]:
+        """
+        The fetched surfaces which got no image, except those that failed for a reason which can pass.
+        """
+        retried = {str(failure.surface_id) for failure in failures if failure.transient}
+        found = {str(image.surface_id) for image in images}
+        return [
+            str(bbox.surface_id) for bbox in bboxes
+            if str(bbox.surface_id) not in found and str(bbox.surface_id) not in retried
+        ]
+
+    def _is_current(self, building: Building_dataclass, cache_key: str) -> bool:
+        if self.result_cache.is_current(os.path.join(self.output_dir, building.id), self.filename, cache_key):
+            self.logger.info(f"{building.id}: output is up to date")
+            return True
+        return False
+
+    def _drain(self, in_flight: Dict[Future, str], result: BatchResult, return_when: str = 'ALL_COMPLETED') -> None:
+        done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            bag_building_id = in_flight.pop(future)
+            try:
+                future.result()
+            except NoDataFound as e:
+                self.logger.warning(f"{bag_building_id}: {e}")
+                result.skipped.append(bag_building_id)
+            except Exception as e:
+                self.logger.error(f"{bag_building_id}: {e}")
+                result.failed[bag_building_id] = str(e)
+            else:
+                result.succeeded.append(bag_building_id)
@@ -29,3 +29,42 @@ class Calculator:
         argmin = np.argmin(polygon.exterior.coords, axis=0).tolist()
         argmax = np.argmax(polygon.exterior.coords, axis=0).tolist()
         return argmin, argmax
+
+    def _get_azimuths(self, first_points: np.ndarray, last_points: np.ndarray) -> np.ndarray:
+        """
+        Vectorized _get_azimuth for (n, 2+) arrays of points.
+        """
+        azimuths = np.degrees(np.arctan2(
+            last_points[:, 0] - first_points[:, 0],
+            last_points[:, 1] - first_points[:, 1]
+        ))
+        return (azimuths + 360) % 360
+
+    def _rotate_rings(
+        self,
+        rings: np.ndarray,
+        degrees: np.ndarray,
+        required_angle: int = 45
+    ) -> np.ndarray:
+        """
+        Vectorized _rotate_wall for padded (rings, points, 3) arrays,
+        every ring is rotated counter clockwise around its first point, z is left as is.
+        """
+        angles = np.radians(degrees - required_angle)
+        cos = np.cos(angles)[:, None]
+        sin = np.sin(angles)[:, None]
+        origins = rings[:, :1, :]
+        dx = rings[:, :, 0] - origins[:, :, 0]
+        dy = rings[:, :, 1] - origins[:, :, 1]
+
+        rotated = rings.copy()
+        rotated[:, :, 0] = origins[:, :, 0] + cos * dx - sin * dy
+        rotated[:, :, 1] = origins[:, :, 1] + sin * dx + cos * dy
+        return rotated
+
+    def _get_min_max_indices_padded(self, rings: np.ndarray) -> Union[np.ndarray, np.ndarray]:
+        """
+        Vectorized _get_min_max_indices for padded (rings, points, 3) arrays, padding is nan.
+        Returns (rings, 3) arrays of point indices.
+        """
+        return np.nanargmin(rings, axis=1), np.nanargmax(rings, axis=1)
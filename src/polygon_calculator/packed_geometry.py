@@ -0,0 +1,176 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+try:
+    # shapely >= 2.0 extracts the coordinates of all geometries at once
+    from shapely import get_coordinates, get_exterior_ring, get_num_coordinates
+except ImportError:
+    get_coordinates = None
+
+# the type of a polygon with z coordinates in ISO WKB (PostGIS) and in EWKB (shapely 1.8), and the EWKB srid flag
+WKB_POLYGON_Z = 1003
+EWKB_POLYGON_Z = 0x80000003
+EWKB_SRID = 0x20000000
+
+from models.dataclass_mappings.surfaces import Surface_dataclass
+
+
+@dataclass
+class RingBounds:
+    """
+    The minimum and maximum (x, y, z) of every ring, as (rings, 3) arrays.
+    """
+    minimum: np.ndarray
+    maximum: np.ndarray
+
+    def extent(self, indices: np.ndarray = None) -> List[float]:
+        """
+        [x min, y min, z min, x max, y max, z max] of all rings, or of the rings at the supplied indices.
+        """
+        minimum = self.minimum if indices is None else self.minimum[indices]
+        maximum = self.maximum if indices is None else self.maximum[indices]
+        return minimum.min(axis=0).tolist() + maximum.max(axis=0).tolist()
+
+
+@dataclass
+class PackedRings:
+    """
+    The exterior rings of many surfaces packed into one (n, 3) coordinate array,
+    ring i spans coordinates[offsets[i]:offsets[i + 1]].
+    Rings keep their closing point, like shapely exterior coords.
+    """
+    coordinates: np.ndarray
+    offsets: np.ndarray
+
+    @classmethod
+    def from_surfaces(cls, surfaces: List[Surface_dataclass]) -> 'PackedRings':
+        return cls.from_polygons([surface.surface_geometry for surface in surfaces])
+
+    @classmethod
+    def from_polygons(cls, polygons: List) -> 'PackedRings':
+        if not polygons:
+            return cls(coordinates=np.empty((0, 3)), offsets=np.zeros(1, dtype=np.int64))
+        if get_coordinates is not None:
+            exteriors = get_exterior_ring(np.asarray(polygons, dtype=object))
+            coordinates = get_coordinates(exteriors, include_z=True)
+            lengths = get_num_coordinates(exteriors)
+        else:
+            # shapely 1.8 has no array functions, reading the rings from the WKB of the polygons
+            # at once is about twice as fast as converting the coords of every ring to an array.
+            packed = cls.from_wkb([polygon.wkb for polygon in polygons])
+            if packed is not None:
+                return packed
+            rings = [np.asarray(polygon.exterior.coords) for polygon in polygons]
+            coordinates = np.concatenate(rings)
+            lengths = [len(ring) for ring in rings]
+        offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(coordinates=np.asarray(coordinates, dtype=np.float64), offsets=offsets)
+
+    @classmethod
+    def from_wkb(cls, blobs: List[bytes]) -> Optional['PackedRings']:
+        """
+        Packs the exterior rings of little endian polygon z WKB, ISO or EWKB, by gathering the coordinate bytes
+        of all polygons with numpy, no geometry is decoded. None when a blob is anything else.
+        """
+        if not blobs:
+            return cls(coordinates=np.empty((0, 3)), offsets=np.zeros(1, dtype=np.int64))
+        sizes = np.fromiter((len(blob) for blob in blobs), dtype=np.int64, count=len(blobs))
+        buffer = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+        starts = np.zeros(len(blobs), dtype=np.int64)
+        np.cumsum(sizes[:-1], out=starts[1:])
+        if (sizes < 17).any() or (buffer[starts] != 1).any():
+            return None
+
+        types = _read_uint32(buffer, starts + 1)
+        has_srid = (types & EWKB_SRID) != 0
+        if not ((types == WKB_POLYGON_Z) | ((types & ~np.uint32(EWKB_SRID)) == EWKB_POLYGON_Z)).all():
+            return None
+        # the ring count follows the type, or the srid
+        ring_counts_at = starts + 5 + 4 * has_srid
+        if (ring_counts_at + 8 > starts + sizes).any() or (_read_uint32(buffer, ring_counts_at) == 0).any():
+            return None
+        lengths = _read_uint32(buffer, ring_counts_at + 4).astype(np.int64)
+        first_bytes = ring_counts_at + 8
+        ring_sizes = lengths * 24
+        if (first_bytes + ring_sizes > starts + sizes).any():
+            return None
+
+        offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # the position in the buffer of every byte of every exterior ring
+        positions = np.repeat(first_bytes - offsets[:-1] * 24, ring_sizes) + np.arange(offsets[-1] * 24)
+        coordinates = np.asarray(buffer[positions].view('<f8').reshape(-1, 3), dtype=np.float64)
+        return cls(coordinates=coordinates, offsets=offsets)
+
+    @classmethod
+    def from_arrays(cls, rings: List) -> 'PackedRings':
+        """
+        Packs rings that are already coordinate lists or arrays.
+        """
+        if not rings:
+            return cls(coordinates=np.empty((0, 3)), offsets=np.zeros(1, dtype=np.int64))
+        arrays = [np.asarray(ring, dtype=np.float64) for ring in rings]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in arrays], out=offsets[1:])
+        return cls(coordinates=np.concatenate(arrays), offsets=offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def ring(self, index: int) -> np.ndarray:
+        return self.coordinates[self.offsets[index]:self.offsets[index + 1]]
+
+    def take(self, indices: List[int]) -> 'PackedRings':
+        """
+        The rings at the supplied indices, packed in that order, without going back to the polygons.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(self.offsets[:-1][indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return PackedRings(coordinates=self.coordinates[positions], offsets=offsets)
+
+    def ring_indices(self) -> np.ndarray:
+        """
+        The ring each coordinate belongs to.
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def bounds(self) -> RingBounds:
+        """
+        The bounds of all rings in one pass over the coordinates.
+        """
+        if len(self) == 0:
+            return RingBounds(minimum=np.empty((0, 3)), maximum=np.empty((0, 3)))
+        starts = self.offsets[:-1]
+        return RingBounds(
+            minimum=np.minimum.reduceat(self.coordinates, starts, axis=0),
+            maximum=np.maximum.reduceat(self.coordinates, starts, axis=0)
+        )
+
+    def padded(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The rings as a (rings, longest ring, 3) array, padded with nan,
+        together with the (rings, longest ring) mask of real coordinates.
+        """
+        lengths = self.lengths
+        longest = int(lengths.max()) if len(lengths) else 0
+        mask = np.arange(longest) < lengths[:, None]
+        padded = np.full((len(self), longest, 3), np.nan)
+        padded[mask] = self.coordinates
+        return padded, mask
+
+
+def _read_uint32(buffer: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    The little endian uint32 at each of the byte positions of the buffer.
+    """
+    return buffer[positions[:, None] + np.arange(4)].view('<u4').ravel()
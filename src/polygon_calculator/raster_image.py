@@ -0,0 +1,73 @@
+import io
+from threading import Lock
+
+import numpy as np
+from PIL import Image
+from rasterio import MemoryFile
+
+
+class RasterImage:
+    """
+    A decoded image as a (bands, rows, columns) array, as rasterio reads it.
+
+    Cropped roof images are carried as arrays through the pipeline and only compressed
+    when they reach a sink (the database or a texture file), the PNG is encoded once
+    and shared by all sinks.
+    """
+
+    # band counts PIL can take as an array directly: grey, rgb and rgba
+    PIL_BANDS = (1, 3, 4)
+
+    def __init__(self, array: np.ndarray) -> None:
+        self.array = array
+        self._png = None
+        self._lock = Lock()
+
+    @property
+    def width(self) -> int:
+        return self.array.shape[2]
+
+    @property
+    def height(self) -> int:
+        return self.array.shape[1]
+
+    def __bytes__(self) -> bytes:
+        return self.encode()
+
+    def encode(self) -> bytes:
+        """
+        The image as PNG, encoded on the first call.
+        """
+        with self._lock:
+            if self._png is None:
+                self._png = self._encode_png()
+            return self._png
+
+    def to_pil(self) -> Image.Image:
+        if not self._has_pil_mode():
+            return Image.open(io.BytesIO(self.encode()))
+        pixels = np.moveaxis(self.array, 0, -1)
+        if pixels.shape[2] == 1:
+            pixels = pixels[:, :, 0]
+        return Image.fromarray(np.ascontiguousarray(pixels))
+
+    def _has_pil_mode(self) -> bool:
+        return self.array.dtype == np.uint8 and self.array.shape[0] in self.PIL_BANDS
+
+    def _encode_png(self) -> bytes:
+        if self._has_pil_mode():
+            buffer = io.BytesIO()
+            self.to_pil().save(buffer, format='PNG')
+            return buffer.getvalue()
+
+        # other band counts or data types through gdal
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver='PNG',
+                height=self.height,
+                width=self.width,
+                count=self.array.shape[0],
+                dtype=self.array.dtype
+            ) as dataset:
+                dataset.write(self.array)
+            return memfile.read()
@@ -1,5 +1,9 @@
 
+import os
+from collections import defaultdict
+from math import ceil
 from typing import Dict, List
+from uuid import uuid4
 
 from rasterio import MemoryFile
 from rasterio.mask import mask
@@ -10,30 +14,48 @@ from shapely.affinity import rotate
 import logging
 
 from src.polygon_calculator.calculator import Calculator
+from src.polygon_calculator.packed_geometry import PackedRings
+from src.polygon_calculator.raster_image import RasterImage
+from src.worker_pool import WorkerPool
 from models.dataclass_mappings.surfaces import Surface_type, Surface_dataclass
 from models.dataclass_mappings.bounding_box import BoundingBox
 from models.dataclass_mappings.buildings import Building_dataclass
-from models.dataclass_mappings.image import Aerial_Image_dataclass
+from models.dataclass_mappings.image import Aerial_Image_dataclass, Aerial_Tile_dataclass, Image_dataclass
 
 
 class SurfaceCalculator(Calculator):
 
-    def __init__(self) -> None:
+    def __init__(self, workers: int = None) -> None:
+        """
+        Roof images are cropped on a pool of worker threads, rasterio releases the GIL while masking.
+        """
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
 
-    def calculate_surface_bounding_boxes(self, building: Building_dataclass) -> List:
+        self.workers = workers or os.cpu_count() or 4
+        self._pool = WorkerPool(self.workers, thread_name_prefix='crop')
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def calculate_surface_bounding_boxes(self, building: Building_dataclass, packed: PackedRings = None) -> List:
         """
         creates a list of bounding boxes.
+        The walls and roofs are taken from the packed surfaces of the building, which are packed here unless supplied.
         """
-        outer_wall_bbox_list = []
-        roof_bbox_list = []
-        for surface in building.surfaces:
-            if surface.semantics_value == Surface_type.OuterWallSurface:
-                outer_wall_bbox_list.append(self._create_bounding_box(surface))
-            elif surface.semantics_value == Surface_type.RoofSurface:
-                roof_bbox_list.append(self._create_bounding_box(surface))
-        return outer_wall_bbox_list, roof_bbox_list
+        packed = packed if packed is not None else PackedRings.from_surfaces(building.surfaces)
+        outer_walls = [
+            index for index, surface in enumerate(building.surfaces)
+            if surface.semantics_value == Surface_type.OuterWallSurface
+        ]
+        roofs = [
+            index for index, surface in enumerate(building.surfaces)
+            if surface.semantics_value == Surface_type.RoofSurface
+        ]
+        return (
+            self._create_bounding_boxes([building.surfaces[index] for index in outer_walls], packed.take(outer_walls)),
+            self._create_bounding_boxes([building.surfaces[index] for index in roofs], packed.take(roofs))
+        )
 
     def process_roof_images(
         self,
@@ -43,22 +65,60 @@ class SurfaceCalculator(Calculator):
         """
         Supplied with a building and a list of images do the following:
         - find the matching surfaces with the image
+          (a shared tile of several roofs matches each of those roofs)
         - crops the images and put them in a new dataclass.
+
+        The images are indexed on surface id first. The roofs of an image are split over the workers,
+        every worker opens the image once for its share of the roofs, so the roofs of one shared tile
+        are cropped in parallel too. The crops are returned in roof order.
         """
+        images_per_surface = defaultdict(list)
+        for image_index, image in enumerate(images):
+            for surface_id in self._covered_surface_ids(image):
+                images_per_surface[surface_id].append(image_index)
+
+        # the roofs to crop from every image, with the position of the crop in the output
+        crops_per_image = defaultdict(list)
+        position = 0
+        for roof_surface in building.surfaces:
+            if roof_surface.semantics_value != Surface_type.RoofSurface:
+                continue
+            for image_index in images_per_surface.get(roof_surface.id, []):
+                crops_per_image[image_index].append((position, roof_surface))
+                position += 1
+
+        jobs = []
+        for image_index, crops in crops_per_image.items():
+            chunk_size = ceil(len(crops) / self.workers)
+            jobs.extend(
+                (images[image_index], crops[start:start + chunk_size]) for start in range(0, len(crops), chunk_size)
+            )
+        if len(jobs) <= 1:
+            results = [self._crop_roof_images(image, crops) for image, crops in jobs]
+        else:
+            results = self._pool.map(lambda job: self._crop_roof_images(*job), jobs)
 
-        cropped_images = []
-        roof_surfaces = [
-            surface for surface in building.surfaces if surface.semantics_value == Surface_type.RoofSurface
-        ]
-        for roof_surface in roof_surfaces:
-            for image in images:
-                if image.surface_id == roof_surface.id:
-                    cropped_images.append(self._crop_roof_image(surface=roof_surface, image=image))
+        cropped_images = [None] * position
+        for (_, crops), cropped in zip(jobs, results):
+            for (crop_position, _), cropped_image in zip(crops, cropped):
+                cropped_images[crop_position] = cropped_image
         return cropped_images
 
-    def _create_bounding_box(self, surface: Surface_dataclass) -> BoundingBox:
+    def _covered_surface_ids(self, image: Image_dataclass) -> List:
+        """
+        A shared aerial tile covers all of its surface ids, any other image only its own surface.
         """
-        Creates a bounding box in the format
+        if isinstance(image, Aerial_Tile_dataclass):
+            return image.surface_ids
+        return [image.surface_id]
+
+    def _create_bounding_boxes(
+        self,
+        surfaces: List[Surface_dataclass],
+        packed: PackedRings = None
+    ) -> List[BoundingBox]:
+        """
+        Creates a bounding box for every surface in the format
         Upper left  : x:y:z
         Upper right : x:y:z
         Lower right : x:y:z
@@ -67,91 +127,68 @@ class SurfaceCalculator(Calculator):
         Get the convex hull for each surface (exterior) for each surface
         for walls: use relative coordinates, the corner points are defined you facing against a wall.
         for roofs: use the original polygon,since it's top-down perspective
-        """
-
-        polygon_surface = geometry.Polygon()
-        if surface.semantics_value == Surface_type.OuterWallSurface:
-            first_point = surface.surface_geometry.exterior.coords[0]
-            last_point = surface.surface_geometry.exterior.coords[-2]
-
-            degrees = self._get_azimuth(first_point, last_point)
-            rotated_wall = self._rotate_wall(
-                wall=surface.surface_geometry,
-                degrees=degrees,
-                required_angle=45
-            )
 
-            first_rotated_point = rotated_wall.exterior.coords[0]
-            polygon_surface = geometry.Polygon(
-                np.subtract(rotated_wall.exterior.coords, first_rotated_point)
-            )
-        else:
-            polygon_surface = surface.surface_geometry
-
-        argmin, argmax = self._get_min_max_indices(polygon_surface)
-        bbox = BoundingBox(
-            surface_id=surface.id,
-            upper_left=geometry.Point(
-                surface.surface_geometry.exterior.coords[argmin[0]][0],
-                surface.surface_geometry.exterior.coords[argmin[1]][1],
-                surface.surface_geometry.exterior.coords[argmax[2]][2]
-            ),
-            lower_left=geometry.Point(
-                surface.surface_geometry.exterior.coords[argmin[0]][0],
-                surface.surface_geometry.exterior.coords[argmin[1]][1],
-                surface.surface_geometry.exterior.coords[argmin[2]][2]
-            ),
-            lower_right=geometry.Point(
-                surface.surface_geometry.exterior.coords[argmax[0]][0],
-                surface.surface_geometry.exterior.coords[argmax[1]][1],
-                surface.surface_geometry.exterior.coords[argmin[2]][2],
-            ),
-            upper_right=geometry.Point(
-                surface.surface_geometry.exterior.coords[argmax[0]][0],
-                surface.surface_geometry.exterior.coords[argmax[1]][1],
-                surface.surface_geometry.exterior.coords[argmax[2]][2]
+        All rings are packed into one padded array, so the rotation and min/max lookups
+        run once for all surfaces (of one or more buildings) instead of once per surface.
+        The surfaces are packed here unless their rings were packed already.
+        """
+        if not surfaces:
+            return []
+
+        packed = packed if packed is not None else PackedRings.from_surfaces(surfaces)
+        rings, _ = packed.padded()
+
+        is_wall = np.array([surface.semantics_value == Surface_type.OuterWallSurface for surface in surfaces])
+        oriented_rings = rings
+        if is_wall.any():
+            first_points = packed.coordinates[packed.offsets[:-1]]
+            last_points = packed.coordinates[packed.offsets[1:] - 2]
+            degrees = self._get_azimuths(first_points, last_points)
+            rotated_rings = self._rotate_rings(rings, degrees, required_angle=45)
+            oriented_rings = np.where(is_wall[:, None, None], rotated_rings, rings)
+
+        argmin, argmax = self._get_min_max_indices_padded(oriented_rings)
+        axes = np.arange(3)
+        minimum = rings[np.arange(len(surfaces))[:, None], argmin, axes]
+        maximum = rings[np.arange(len(surfaces))[:, None], argmax, axes]
+
+        bboxes = []
+        for surface, (min_x, min_y, min_z), (max_x, max_y, max_z) in zip(surfaces, minimum.tolist(), maximum.tolist()):
+            bboxes.append(
+                BoundingBox(
+                    surface_id=surface.id,
+                    upper_left=geometry.Point(min_x, min_y, max_z),
+                    lower_left=geometry.Point(min_x, min_y, min_z),
+                    lower_right=geometry.Point(max_x, max_y, min_z),
+                    upper_right=geometry.Point(max_x, max_y, max_z)
+                )
             )
-        )
-
-        return bbox
-
-    def _crop_roof_image(
-        self,
-        surface: Surface_dataclass,
-        image: Aerial_Image_dataclass
-    ) -> Aerial_Image_dataclass:
-
-        # TODO do some error handling here
-        # we just need lat/lon coordinates, z-coordinates can be left out.
-        poly = geometry.Polygon([(point[0], point[1]) for point in surface.surface_geometry.exterior.coords])
+        return bboxes
 
+    def _crop_roof_images(self, image: Image_dataclass, crops: List) -> List[Aerial_Image_dataclass]:
+        """
+        Crops the (position, surface) roofs out of one image, the image is opened once.
+        The cropped images are kept as arrays (a RasterImage),
+        they are encoded only once when they are stored or written to a file.
+        """
+        cropped_images = []
         # opens as read-only
         with MemoryFile(file_or_bytes=image.image, ext='tiff') as memfile:
             with memfile.open() as dataset:
-                cropped_image_array, cropped_transform = mask(dataset=dataset, shapes=[poly], nodata=0, crop=True)
-                cropped_metadata = dataset.meta
-                print(cropped_image_array.shape)
-
-            cropped_metadata.update(
-                {
-                    "driver": "PNG",
-                    "height": cropped_image_array.shape[1],
-                    "width": cropped_image_array.shape[2],
-                    "transform": cropped_transform
-                }
-            )
-
-        # we write the output to a new empty memoryfile
-        with MemoryFile() as memfile2:
-            with memfile2.open(**cropped_metadata) as dataset:
-                dataset.write(cropped_image_array)
-
-            masked_image = memfile2.read()
-
-        return Aerial_Image_dataclass(
-            id=image.id,
-            surface_id=surface.id,
-            image_height=image.image_height,
-            image_width=image.image_width,
-            image=masked_image
-        )
+                for _, surface in crops:
+                    # TODO do some error handling here
+                    # we just need lat/lon coordinates, z-coordinates can be left out.
+                    poly = geometry.Polygon(
+                        [(point[0], point[1]) for point in surface.surface_geometry.exterior.coords]
+                    )
+                    cropped_image_array, _ = mask(dataset=dataset, shapes=[poly], nodata=0, crop=True)
+                    cropped_images.append(
+                        Aerial_Image_dataclass(
+                            id=uuid4(),
+                            surface_id=surface.id,
+                            image_height=image.image_height,
+                            image_width=image.image_width,
+                            image=RasterImage(cropped_image_array)
+                        )
+                    )
+        return cropped_images
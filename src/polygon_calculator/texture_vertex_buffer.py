@@ -0,0 +1,43 @@
+from typing import List
+
+import numpy as np
+
+
+class TextureVertexBuffer:
+    """
+    Collects the texture (uv) vertices of a model in a preallocated array
+    which doubles in size when it is full. Identical uv's are stored once,
+    add returns the index of every supplied uv in the buffer.
+    """
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self._vertices = np.empty((capacity, 2))
+        self._size = 0
+        self._lookup = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, uvs: np.ndarray) -> np.ndarray:
+        if len(uvs) == 0:
+            return np.empty(0, dtype=np.int64)
+        unique_uvs, inverse = np.unique(uvs, axis=0, return_inverse=True)
+        unique_indices = np.empty(len(unique_uvs), dtype=np.int64)
+        for position, uv in enumerate(map(tuple, unique_uvs.tolist())):
+            index = self._lookup.get(uv)
+            if index is None:
+                index = self._append(uv)
+            unique_indices[position] = index
+        return unique_indices[inverse.reshape(-1)]
+
+    def tolist(self) -> List[List[float]]:
+        return self._vertices[:self._size].tolist()
+
+    def _append(self, uv: tuple) -> int:
+        if self._size == len(self._vertices):
+            self._vertices = np.concatenate([self._vertices, np.empty_like(self._vertices)])
+        index = self._size
+        self._vertices[index] = uv
+        self._lookup[uv] = index
+        self._size += 1
+        return index
@@ -1,23 +1,45 @@
-from typing import Dict, List
+from typing import TYPE_CHECKING, Dict, List
 import numpy as np
-from cjio.models import Geometry
-from shapely.affinity import rotate
-from shapely.geometry import Polygon
 
-from models.dataclass_mappings.surfaces import Surface_dataclass
 from src.polygon_calculator.calculator import Calculator
+from src.polygon_calculator.packed_geometry import PackedRings
+from src.polygon_calculator.texture_vertex_buffer import TextureVertexBuffer
+
+if TYPE_CHECKING:
+    # only the cjio generator hands in cjio geometries, keep cjio out of the import chain
+    from cjio.models import Geometry
+
 
 class UVCalculator(Calculator):
 
-    def __init__(self, building_id: str = 'example'):
+    def __init__(self, building_id: str = 'example', texture_type: str = 'PNG', texture_extension: str = 'png'):
         self.building_id = building_id
+        self.texture_type = texture_type
+        self.texture_extension = texture_extension
+        self.texture_vertices = TextureVertexBuffer()
 
     def map_uv_appearance(
         self,
         appearance: Dict,
-        surface: Surface_dataclass,
+        surface: Dict,
         textures_enabled: bool = False
     ) -> List:
+        """
+        Single surface variant of map_uv_appearances.
+        """
+        return self.map_uv_appearances(
+            appearance=appearance,
+            surfaces=[surface],
+            textures_enabled=textures_enabled
+        )[0]
+
+    def map_uv_appearances(
+        self,
+        appearance: Dict,
+        surfaces: List[Dict],
+        textures_enabled: bool = False,
+        packed: PackedRings = None
+    ) -> List[List]:
         """
         This normalizes the surface coordinates (to 0-1) for each point
         and updates the appearance vertices-textures object.
@@ -28,53 +50,80 @@ class UVCalculator(Calculator):
         for roofs we have the face on lat and lon, we can drop the z axis for now
         since roofs are georeferenced, we start from the upper right corner of a roof viewed top-down.
         TODO: check for slanted roofs how the z-axis come into play.
+
+        All rings of all surfaces are handled in one array pass,
+        identical uv's share one entry in vertices-texture.
+        The generators supply the normalized rings the surfaces were extracted from as packed,
+        one ring per surface, otherwise the rings of the surfaces are packed here.
+        Returns the texture indices per surface.
         """
-        texture_indices = []
-        for shell in surface['surface']:
-            first_point = shell[0]
-            last_point = shell[-2]
-            degrees = self._get_azimuth(first_point, last_point)
-            rotated_poly = self._rotate_wall(
-                wall=Polygon(shell),
-                degrees=degrees,
-                required_angle=45
-            )
-            argmin, argmax = self._get_min_max_indices(rotated_poly)
-            lower_left_point = (shell[argmin[0]][0], shell[argmin[1]][1], shell[argmin[2]][2])
-            upper_right_point = (shell[argmax[0]][0], shell[argmax[1]][1], shell[argmax[2]][2])
-
-            # dummy array
-            relative_points = np.empty([0, 3])
-
-            if surface['type'] == 'WallSurface':
-                relative_points = [np.subtract([point[0] + point[1], point[2]], [lower_left_point[0] + lower_left_point[1], lower_left_point[2]]) for point in shell]
-            else:
-                relative_points = [np.subtract([point[0], point[1]], [upper_right_point[0], upper_right_point[1]]) for point in shell]
-            max_coords = np.max(relative_points, axis=-2)
-            min_coords = np.min(relative_points, axis=-2)
-            for point in relative_points:
-                normalized_point = np.round(np.abs((point) / (max_coords - min_coords)), 2).tolist()
-                texture_indices.append(len(appearance["vertices-texture"]))
-                appearance["vertices-texture"].append(normalized_point)
+        texture_indices = [[] for _ in surfaces]
+        if packed is not None:
+            ring_surfaces = list(range(len(surfaces)))
+            packed = PackedRings(coordinates=np.asarray(packed.coordinates, dtype=np.float64), offsets=packed.offsets)
+        else:
+            rings = [shell for surface in surfaces for shell in surface['surface']]
+            ring_surfaces = [index for index, surface in enumerate(surfaces) for _ in surface['surface']]
+            if not rings:
+                return texture_indices
+            packed = PackedRings.from_arrays(rings)
+        if len(packed) == 0:
+            return texture_indices
+
+        padded, _ = packed.padded()
+        points = packed.coordinates
+        point_rings = packed.ring_indices()
+
+        first_points = points[packed.offsets[:-1]]
+        last_points = points[packed.offsets[1:] - 2]
+        degrees = self._get_azimuths(first_points, last_points)
+        rotated_rings = self._rotate_rings(padded, degrees, required_angle=45)
+        argmin, argmax = self._get_min_max_indices_padded(rotated_rings)
+        ring_range = np.arange(len(packed))[:, None]
+        axes = np.arange(3)
+        lower_left_points = padded[ring_range, argmin, axes][point_rings]
+        upper_right_points = padded[ring_range, argmax, axes][point_rings]
+
+        is_wall = np.array([surfaces[index]['type'] == 'WallSurface' for index in ring_surfaces])[point_rings]
+        wall_points = np.column_stack([
+            points[:, 0] + points[:, 1] - (lower_left_points[:, 0] + lower_left_points[:, 1]),
+            points[:, 2] - lower_left_points[:, 2]
+        ])
+        roof_points = points[:, :2] - upper_right_points[:, :2]
+        relative_points = np.where(is_wall[:, None], wall_points, roof_points)
+
+        starts = packed.offsets[:-1]
+        extents = np.maximum.reduceat(relative_points, starts, axis=0) - np.minimum.reduceat(relative_points, starts, axis=0)
+        # a ring without width or height gets 0 instead of nan for that axis
+        extents[extents == 0] = 1
+        normalized_points = np.round(np.abs(relative_points / extents[point_rings]), 2)
+
+        vertex_indices = self.texture_vertices.add(normalized_points).tolist()
+        for ring, surface_index in enumerate(ring_surfaces):
+            texture_indices[surface_index].extend(vertex_indices[packed.offsets[ring]:packed.offsets[ring + 1]])
 
         if textures_enabled:
-            texture = {
-                "type": "PNG",
-                "image": f"/{self.building_id}/{surface['id']}.png",
-            }
-            texture_index = len(appearance["textures"])
-            appearance["textures"].append(texture)
+            for surface, surface_texture_indices in zip(surfaces, texture_indices):
+                # surfaces of a tile carry the building they belong to
+                building_id = surface.get('building_id', self.building_id)
+                texture = {
+                    "type": self.texture_type,
+                    "image": f"/{building_id}/{surface['id']}.{self.texture_extension}",
+                }
+                texture_index = len(appearance["textures"])
+                appearance["textures"].append(texture)
 
-            texture_indices.insert(0, texture_index)
+                surface_texture_indices.insert(0, texture_index)
+            appearance["vertices-texture"] = self.texture_vertices.tolist()
 
         return texture_indices
 
     def construct_texture_maps(
         self,
-        geom: Geometry,
+        geom: 'Geometry',
         texture_indices: List,
         textures_enabled: bool = False
-    ) -> Geometry:
+    ) -> 'Geometry':
         """
         Construct a texture map to be used
         first index refers to the texture object.
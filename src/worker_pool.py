@@ -0,0 +1,37 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Iterable, Iterator
+
+
+class WorkerPool:
+    """
+    A thread pool which is only started on first use, so an owner that never submits work starts no threads.
+    The threads are kept between calls until close, after which the next submit starts a new pool.
+    """
+
+    def __init__(self, workers: int, thread_name_prefix: str = '') -> None:
+        self.workers = workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = None
+        self._lock = Lock()
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        return self._get_executor().submit(function, *args, **kwargs)
+
+    def map(self, function: Callable, *iterables: Iterable) -> Iterator:
+        return self._get_executor().map(function, *iterables)
+
+    def close(self) -> None:
+        """
+        Shuts down the threads, if they were started.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.thread_name_prefix)
+            return self._executor
@@ -0,0 +1,175 @@
+"""
+Fetches images through the shared session against a stub WMS and streetview server on localhost.
+
+    python -m pytest tests
+"""
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from urllib.parse import urlparse
+
+import pytest
+from shapely.geometry import Point
+
+from src.image_extractor.image_collector import ImageCollector
+from src.image_extractor.rate_limiter import RetryPolicy, TokenBucket
+from models.dataclass_mappings.bounding_box import BoundingBox
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves GetMap and RenderSurface responses, the first `throttled` requests of a path get a 429.
+    """
+    # keep-alive, so the connection reuse of the pooled session can be observed
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        path = urlparse(self.path).path
+        with server.lock:
+            server.requests[path] += 1
+            server.client_ports.add(self.client_address[1])
+            throttled = server.requests[path] <= server.throttled
+
+        if server.delay:
+            sleep(server.delay)
+        if throttled:
+            self._respond(429, b'', {'Retry-After': str(server.retry_after)})
+        elif path.startswith('/PanoramaRendering/RenderSurface/'):
+            self._respond(200, b'streetview', {
+                'Content-Type': 'image/jpeg',
+                'Recording-Id': 'recording',
+                'RecordingLocation-X': '155000.0',
+                'RecordingLocation-Y': '463000.0',
+                'RecordingLocation-Z': '2.0',
+                'Recording-Date': '2021-06-01',
+                'Render-Width': '10',
+                'Render-Height': '10'
+            })
+        elif path == '/wms':
+            self._respond(200, b'aerial', {'Content-Type': 'image/tiff'})
+        else:
+            self._respond(404, b'', {})
+
+    def _respond(self, status: int, body: bytes, headers: dict) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = defaultdict(int)
+    server.client_ports = set()
+    server.throttled = 0
+    server.retry_after = 0
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def collector(stub_server, monkeypatch):
+    url = f"http://127.0.0.1:{stub_server.server_port}"
+    monkeypatch.setenv('cyclomedia_streetview_url', f"{url}/PanoramaRendering")
+    monkeypatch.setenv('cyclomedia_wms_url', f"{url}/wms")
+    monkeypatch.delenv('wms_tile_cache_path', raising=False)
+
+    collector = ImageCollector(workers=2, shared_aerial_tiles=False)
+    collector.streetview_limiter = TokenBucket(rate=1000)
+    collector.wms_limiter = collector.wmsService.limiter = TokenBucket(rate=1000)
+    collector.retry_policy = RetryPolicy(attempts=3, base_delay=0.01, max_delay=1.0)
+    yield collector
+    collector.close()
+
+
+def bbox(surface_id: str, x: float) -> BoundingBox:
+    return BoundingBox(
+        surface_id=surface_id,
+        lower_left=Point(x, 463000.0, 0.0),
+        upper_left=Point(x, 463000.0, 6.0),
+        upper_right=Point(x + 10.0, 463000.0, 6.0),
+        lower_right=Point(x + 10.0, 463000.0, 0.0)
+    )
+
+
+def test_pooled_fetch(collector, stub_server):
+    walls = [bbox(f"wall{index}", 155000.0 + index) for index in range(10)]
+    roofs = [bbox(f"roof{index}", 155000.0 + index) for index in range(10)]
+
+    panoramas, streetview_images, aerial_images, failures = collector.collect_images(walls, roofs)
+
+    assert failures == []
+    assert sorted(image.surface_id for image in streetview_images) == sorted(bbox.surface_id for bbox in walls)
+    assert all(image.image == b'streetview' for image in streetview_images)
+    assert [panorama.panorama_id for panorama in panoramas] == ['recording'] * len(walls)
+    assert sorted(image.surface_id for image in aerial_images) == sorted(bbox.surface_id for bbox in roofs)
+    assert all(image.image == b'aerial' for image in aerial_images)
+    # 20 requests over keep-alive connections of a pool sized to the workers
+    assert sum(stub_server.requests.values()) == 20
+    assert len(stub_server.client_ports) <= collector.workers
+
+
+def test_throttled_fetch_is_retried_after_retry_after(collector, stub_server):
+    stub_server.throttled = 1
+    stub_server.retry_after = 0.2
+
+    start = monotonic()
+    result = collector._get_streetview_images(bbox('wall', 155000.0))
+
+    assert result.ok
+    assert result.attempts == 2
+    assert monotonic() - start >= 0.2
+    # the wait asked for by the service applies to the whole limiter
+    assert collector.streetview_limiter._paused_until > 0
+
+
+def test_throttled_fetch_gives_up_without_a_last_backoff(collector, stub_server):
+    stub_server.throttled = 100
+    stub_server.retry_after = 0.2
+
+    start = monotonic()
+    result = collector._get_aerial_images(bbox('roof', 155000.0))
+
+    assert not result.ok
+    assert result.attempts == collector.retry_policy.attempts
+    assert sum(stub_server.requests.values()) == collector.retry_policy.attempts
+    # two waits between three attempts, none after the last one
+    assert monotonic() - start < 0.2 * collector.retry_policy.attempts
+
+
+def test_stalled_response_times_out_and_is_retried(collector, stub_server):
+    stub_server.delay = 1.0
+    collector.streetviewService.timeout = 0.2
+
+    start = monotonic()
+    result = collector._get_streetview_images(bbox('wall', 155000.0))
+
+    assert not result.ok
+    assert 'timed out' in result.error
+    assert result.attempts == collector.retry_policy.attempts
+    assert sum(stub_server.requests.values()) == collector.retry_policy.attempts
+    # every attempt gives up at the timeout, instead of waiting for the stalled response
+    assert monotonic() - start < stub_server.delay * collector.retry_policy.attempts
+
+
+def test_client_error_is_not_retried(collector, stub_server, monkeypatch):
+    monkeypatch.setattr(collector.streetviewService, 'cyclomediaStreetviewBase', collector.wmsService.url + '/missing')
+
+    result = collector._get_streetview_images(bbox('wall', 155000.0))
+
+    assert not result.ok
+    assert result.status_code == 404
+    assert result.attempts == 1
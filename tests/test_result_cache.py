@@ -0,0 +1,42 @@
+"""
+Records the surfaces without an image next to the cache key.
+
+    python -m pytest tests
+"""
+import os
+from datetime import timedelta
+from time import time
+
+from src.image_extractor.fetch_result import FetchResult
+from src.model_generator.result_cache import ResultCache
+
+
+def test_missing_surfaces_are_stored_with_the_key(tmp_path):
+    ResultCache.store(str(tmp_path), 'key', ['wall', 'roof'])
+
+    assert ResultCache(enabled=True).missing_surface_ids(str(tmp_path)) == {'wall', 'roof'}
+
+
+def test_missing_surfaces_expire(tmp_path):
+    ResultCache.store(str(tmp_path), 'key', ['wall'])
+    two_days_ago = time() - timedelta(days=2).total_seconds()
+    os.utime(tmp_path / ResultCache.MISSING_FILE, (two_days_ago, two_days_ago))
+
+    assert ResultCache(enabled=True, missing_max_age=timedelta(days=1)).missing_surface_ids(str(tmp_path)) == set()
+    # storing them again restarts the expiry
+    ResultCache.store_missing(str(tmp_path), ['wall'])
+    assert ResultCache(enabled=True, missing_max_age=timedelta(days=1)).missing_surface_ids(str(tmp_path)) == {'wall'}
+
+
+def test_nothing_is_stored_without_a_key(tmp_path):
+    ResultCache.store(str(tmp_path), None, ['wall'])
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_only_client_errors_are_permanent():
+    assert not FetchResult(surface_id='wall', service='streetview', error='bad request', status_code=400).transient
+    assert FetchResult(surface_id='wall', service='streetview', error='throttled', status_code=429).transient
+    assert FetchResult(surface_id='wall', service='streetview', error='server error', status_code=503).transient
+    assert FetchResult(surface_id='wall', service='streetview', error='gave up after 3 attempts').transient
+    assert not FetchResult(surface_id='wall', service='streetview', value=b'image').transient